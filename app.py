@@ -1,172 +1,1332 @@
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import logging
 import os
-from datetime import datetime
-
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import click
 import firebase_admin
-import mysql.connector
 import phpserialize
 import pymysql.cursors
 import requests
 import stripe
 from firebase_admin import credentials
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort, g, has_request_context, send_file, stream_with_context
 from flask_caching import Cache
 from flask_cors import CORS
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room, leave_room, rooms
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 
 CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*"}},
-     allow_headers=["Authorization", "Content-Type", "X-API-Key"])
+     allow_headers=["Authorization", "Content-Type", "X-API-Key", "X-User-Id"], expose_headers=["X-Next-After"])
+
+# With several workers, Socket.IO events go through this queue (e.g. redis://) to reach the clients of every worker
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or os.environ.get('CACHE_REDIS_URL')
+
+# threading for `python app.py`, findforme_async.py switches to eventlet (see there)
+SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+
+# Socket.IO/Engine.IO log every packet, only turn it on to debug the sockets
+SOCKETIO_LOG = os.environ.get('SOCKETIO_LOG', '0') == '1'
 
-socketio = SocketIO(app, logger=True, engineio_logger=True, cors_allowed_origins="*")  # TODO estudar CORS
+socketio = SocketIO(app, logger=SOCKETIO_LOG, engineio_logger=SOCKETIO_LOG,
+                    cors_allowed_origins="*",  # TODO estudar CORS
+                    message_queue=SOCKETIO_MESSAGE_QUEUE, async_mode=SOCKETIO_ASYNC_MODE)
 
-cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
+# SimpleCache lives inside each process, which is only right with a single worker. With more workers use
+# CACHE_TYPE=FileSystemCache (shared through CACHE_DIR, no extra service) or set CACHE_REDIS_URL: every worker
+# then reads the same entries and the same invalidation tokens, so an invalidation in one worker reaches all.
+cache = Cache(app, config={
+    'CACHE_TYPE': os.environ.get('CACHE_TYPE') or ('RedisCache' if os.environ.get('CACHE_REDIS_URL') else 'SimpleCache'),
+    'CACHE_DEFAULT_TIMEOUT': 300,
+    'CACHE_THRESHOLD': int(os.environ.get('CACHE_THRESHOLD', 5000)),
+    'CACHE_DIR': os.environ.get('CACHE_DIR', os.path.join(app.instance_path, 'cache')),
+    'CACHE_REDIS_URL': os.environ.get('CACHE_REDIS_URL'),
+    'CACHE_KEY_PREFIX': 'skipy:',
+})
 
 cred = credentials.Certificate("/root/qjump-api/my-first-project-5e08d-firebase-adminsdk-rpwps-b8ad93251d.json")
 firebase_admin.initialize_app(cred)
 
 # TODO WORDPRESS KEY: iQlvL@~CCb,TW)RJ47Vk3RW:+L1)FFIb6)BWjma-Gg+Qe%qC>X
-WC_API_URL = 'https://skipy.online/wp-json/wc/v3'
+WC_API_URL = os.environ.get('WC_API_URL', 'https://skipy.online/wp-json/wc/v3')
 CONSUMER_KEY = 'ck_b6d4bab7af943dd44fab3902735281511151df20'
 CONSUMER_SECRET = 'cs_b70925c86fe66dcc3b24108104240ba829ee75b8'
 SEC_KEY = '27072001'
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)  # e.g. a local stripe-mock
 stripe.api_key = "sk_test_51OX5FkH6esboORTBVLyd5v5sA7lMgDMQstDExbujgMdHvQwAHDJvxH1zmlXs8CkxyhylDcGxoOZF3SRyD0hRA85M00Hb1PhBhX"
 # Assuming your API key is stored in an environment variable or secure location
 API_SEC_KEY = 'sk_test_51OX5FkH6esboORTBVLyd5v5sA7lMgDMQstDExbujgMdHvQwAHDJvxH1zmlXs8CkxyhylDcGxoOZF3SRyD0hRA85M00Hb1PhBhX'
 
+# Database configuration - update these values based on your database
+db_config = {
+    'user': 'wordpress',
+    'password': 'admin123',
+    'host': 'localhost',
+    'database': 'wordpress',
+}
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))  # max open connections
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600))  # seconds before a connection is reopened
+DB_POOL_PING_INTERVAL = int(os.environ.get('DB_POOL_PING_INTERVAL', 30))  # ping connections idle for longer
+
+
+# ===================== Database connection pool =====================
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class InstrumentedConnection(pymysql.connections.Connection):
+    # Every cursor (buffered or not) runs its statements through query(), so timing it here covers them all.
+    # For unbuffered cursors that is the time to the first row.
+    def query(self, sql, unbuffered=False):
+        started = time.perf_counter()
+        try:
+            return super().query(sql, unbuffered)
+        finally:
+            record_db_query(time.perf_counter() - started)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of pymysql connections shared by every request.
+
+    Idle connections are pinged before reuse, reopened when older than `recycle` seconds and
+    discarded when a query fails with a connection error.
+    """
+
+    def __init__(self, size, timeout, recycle, ping_interval, **connect_kwargs):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self.connect_kwargs = connect_kwargs
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.checkout_time_total = 0.0
+        self.checkout_time_max = 0.0
+
+    def _connect(self):
+        # autocommit so a pooled connection never keeps an old REPEATABLE READ snapshot
+        connection = InstrumentedConnection(cursorclass=pymysql.cursors.DictCursor, autocommit=True,
+                                            **self.connect_kwargs)
+        connection.pool_created_at = time.monotonic()
+        connection.pool_released_at = connection.pool_created_at
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            self._opened -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass  # already closed or broken
+
+    def _reserve_slot(self):
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return True
+        return False
+
+    def _open(self):
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def _healthy(self, connection):
+        now = time.monotonic()
+        if now - connection.pool_created_at > self.recycle:
+            self.recycled += 1
+            return False
+        if now - connection.pool_released_at > self.ping_interval:
+            try:
+                connection.ping(reconnect=False)
+            except Exception:
+                self.recycled += 1
+                return False
+        return True
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                if self._reserve_slot():
+                    return self._open()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError('No database connection available')
+                try:
+                    connection = self._idle.get(timeout=min(remaining, 0.5))
+                except queue.Empty:
+                    continue  # a slot may have been freed by a discarded connection
+
+            if self._healthy(connection):
+                return connection
+
+            self._discard(connection)
+            if self._reserve_slot():
+                return self._open()
+
+    def checkout(self):
+        started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        try:
+            connection = self._acquire()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.checkout_time_total += elapsed
+            self.checkout_time_max = max(self.checkout_time_max, elapsed)
+        return connection
+
+    def release(self, connection, broken=False):
+        with self._lock:
+            self.in_use -= 1
+
+        if broken or not connection.open:
+            self.recycled += 1
+            self._discard(connection)
+            return
+
+        connection.pool_released_at = time.monotonic()
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        broken = False
+        try:
+            yield connection
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._opened,
+                'in_use': self.in_use,
+                'idle': self._idle.qsize(),
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'recycled': self.recycled,
+                'checkout_latency_avg_ms': (self.checkout_time_total / self.checkouts * 1000
+                                            if self.checkouts else 0.0),
+                'checkout_latency_max_ms': self.checkout_time_max * 1000,
+            }
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_INTERVAL, **db_config)
+
+
+@contextmanager
+def db_connection():
+    """
+    Pooled connection for the current request. The connection is checked out on first use and
+    returned to the pool when the request ends; outside of a request it is returned right away.
+    """
+    if not has_request_context():
+        with db_pool.connection() as connection:
+            yield connection
+        return
+
+    if 'db_connection' not in g:
+        g.db_connection = db_pool.checkout()
+    try:
+        yield g.db_connection
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+        # Don't hand a broken connection to the rest of the request
+        db_pool.release(g.pop('db_connection'), broken=True)
+        raise
+
+
+@app.teardown_request
+def release_db_connection(exception=None):
+    connection = g.pop('db_connection', None)
+    if connection is not None:
+        db_pool.release(connection)
+
+
+@app.errorhandler(PoolTimeoutError)
+def handle_pool_timeout(error):
+    app.logger.error(f"Database pool exhausted: {db_pool.stats()}")
+    return jsonify({'error': 'Database busy, try again later'}), 503
+
+
+# ===================== Local database =====================
+
+# SQLite file next to the app holding the state that belongs to this API and not to WordPress
+LOCAL_DB_PATH = os.environ.get('LOCAL_DB_PATH', os.path.join(app.instance_path, 'skipy.db'))
+
+LOCAL_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    order_id INTEGER PRIMARY KEY,
+    date_created TEXT,
+    status TEXT NOT NULL,
+    billing_first_name TEXT,
+    billing_last_name TEXT,
+    billing_email TEXT,
+    billing_phone TEXT,
+    total TEXT,
+    store_name TEXT,
+    payment_method_title TEXT,
+    projected_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_store_status ON orders (store_name, status, order_id);
+CREATE INDEX IF NOT EXISTS orders_status ON orders (status, order_id);
+
+CREATE TABLE IF NOT EXISTS order_items (
+    order_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    product_id TEXT,
+    name TEXT,
+    quantity TEXT,
+    price TEXT,
+    PRIMARY KEY (order_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS status_outbox (
+    order_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    queued_at REAL NOT NULL,
+    last_error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS order_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id INTEGER NOT NULL,
+    store_name TEXT,
+    event TEXT NOT NULL,
+    payload TEXT,
+    created_at REAL NOT NULL
+);
+-- removals only, for get_order_changes
+CREATE INDEX IF NOT EXISTS order_events_removed ON order_events (created_at) WHERE payload = 'null';
+
+CREATE TABLE IF NOT EXISTS webhook_inbox (
+    key TEXT PRIMARY KEY,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    modified TEXT,
+    received_at REAL NOT NULL,
+    due_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS refunds (
+    order_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    charge_id TEXT,
+    stripe_refund_id TEXT,
+    idempotency_key TEXT NOT NULL,
+    batch_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS refunds_batch ON refunds (batch_id);
+CREATE INDEX IF NOT EXISTS refunds_state ON refunds (state);
+
+CREATE TABLE IF NOT EXISTS product_images (
+    media_id INTEGER PRIMARY KEY,
+    image_hash TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS local_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_local_db = threading.local()
+_local_db_schema_ready = False
+
+
+def local_db():
+    # sqlite3 connections can't be shared between threads, so each thread gets its own. Under eventlet
+    # that is one per green thread, i.e. per request, so opening one must stay cheap.
+    global _local_db_schema_ready
+    connection = getattr(_local_db, 'connection', None)
+    if connection is None:
+        if not _local_db_schema_ready:
+            os.makedirs(os.path.dirname(LOCAL_DB_PATH), exist_ok=True)
+        # check_same_thread is off for eventlet's OS threads below, the connection still only has one user
+        connection = sqlite3.connect(LOCAL_DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA synchronous=NORMAL')
+        if not _local_db_schema_ready:
+            connection.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer, stays set in the file
+            connection.executescript(LOCAL_DB_SCHEMA)
+            _local_db_schema_ready = True
+        if SOCKETIO_ASYNC_MODE == 'eventlet':
+            # sqlite3 isn't monkey patched: a write waiting on the lock (up to the 30s busy timeout) or a
+            # big query would stop the whole hub. Every call goes to eventlet's OS threads instead, like
+            # the Pillow work (see off_hub), and only parks its own green thread.
+            from eventlet import tpool
+            connection = tpool.Proxy(connection, autowrap=(sqlite3.Cursor,))
+        _local_db.connection = connection
+    return connection
+
+
+@contextmanager
+def local_transaction():
+    connection = local_db()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+# ===================== WooCommerce client =====================
+
+WC_CONNECT_TIMEOUT = float(os.environ.get('WC_CONNECT_TIMEOUT', 3.05))
+WC_READ_TIMEOUT = float(os.environ.get('WC_READ_TIMEOUT', 20))
+WC_RETRIES = int(os.environ.get('WC_RETRIES', 3))  # for idempotent calls only
+WC_BACKOFF_FACTOR = 0.3  # seconds, doubled on every retry
+WC_POOL_SIZE = int(os.environ.get('WC_POOL_SIZE', 20))  # keep-alive connections to the WordPress host
+WC_CIRCUIT_FAILURES = int(os.environ.get('WC_CIRCUIT_FAILURES', 5))  # consecutive failures opening the circuit
+WC_CIRCUIT_COOLDOWN = float(os.environ.get('WC_CIRCUIT_COOLDOWN', 30))  # seconds before trying again
+WC_VERIFY_SSL = os.environ.get('WC_VERIFY_SSL', '0') == '1'  # TODO Proper SSL verification is recommended in production
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class WooCommerceUnavailableError(Exception):
+    pass
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self._lock:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class WooCommerceClient:
+    """
+    Single keep-alive session for every call to the WooCommerce REST API.
+
+    Idempotent calls (GET, PUT, DELETE) are retried with backoff on connection errors, 429 and 5xx.
+    After `circuit_failures` consecutive failures the circuit opens and calls fail right away for
+    `circuit_cooldown` seconds, then a single call is let through to probe the site.
+    """
+
+    def __init__(self, base_url, key, secret, timeout, retries, pool_size, verify, circuit_failures,
+                 circuit_cooldown):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.circuit_failures = circuit_failures
+        self.circuit_cooldown = circuit_cooldown
+
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(key, secret)
+        self.session.verify = verify
+        # Retry-After isn't followed so a call has a known worst case (see worst_case_seconds)
+        retry = Retry(total=retries, backoff_factor=WC_BACKOFF_FACTOR, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']),
+                      raise_on_status=False, respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.latency = {}  # endpoint -> LatencyHistogram
+        self.errors = {}  # endpoint -> failed calls
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def _allow_call(self):
+        with self._lock:
+            if self._failures < self.circuit_failures:
+                return
+            now = time.monotonic()
+            if now < self._open_until:
+                raise WooCommerceUnavailableError('WooCommerce circuit open, not calling the API')
+            self._open_until = now + self.circuit_cooldown  # let this call probe, hold the others back
+
+    def _record(self, endpoint, seconds, failed):
+        histogram = self.latency.get(endpoint)
+        if histogram is None:
+            histogram = self.latency.setdefault(endpoint, LatencyHistogram())
+        histogram.observe(seconds)
+
+        with self._lock:
+            if failed:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                self._failures += 1
+                if self._failures >= self.circuit_failures:
+                    self._open_until = time.monotonic() + self.circuit_cooldown
+            else:
+                self._failures = 0
+
+    def request(self, method, path, **kwargs):
+        # Ids are replaced so all the calls to the same route share their stats
+        route = re.sub(r'/\d+', '/{id}', '/' + path.strip('/'))
+        endpoint = f"{method} {route}"
+        self._allow_call()
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}/{path.lstrip('/')}",
+                                            timeout=kwargs.pop('timeout', self.timeout), **kwargs)
+        except requests.RequestException as e:
+            self._record(endpoint, time.perf_counter() - started, failed=True)
+            raise WooCommerceUnavailableError(f"{endpoint} failed: {e}") from e
+
+        self._record(endpoint, time.perf_counter() - started, failed=response.status_code >= 500)
+        return response
+
+    def worst_case_seconds(self):
+        # Longest a retried call can take when every attempt times out, backoff included
+        connect, read = self.timeout
+        backoff = sum(min(Retry.DEFAULT_BACKOFF_MAX, WC_BACKOFF_FACTOR * 2 ** attempt)
+                      for attempt in range(self.retries))
+        return (self.retries + 1) * (connect + read) + backoff
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            circuit = 'open' if (self._failures >= self.circuit_failures
+                                 and time.monotonic() < self._open_until) else 'closed'
+            errors = dict(self.errors)
+        return {
+            'circuit': circuit,
+            'endpoints': {endpoint: {**histogram.snapshot(), 'errors': errors.get(endpoint, 0)}
+                          for endpoint, histogram in list(self.latency.items())},
+        }
+
+
+wc_client = WooCommerceClient(WC_API_URL, CONSUMER_KEY, CONSUMER_SECRET, (WC_CONNECT_TIMEOUT, WC_READ_TIMEOUT),
+                              WC_RETRIES, WC_POOL_SIZE, WC_VERIFY_SSL, WC_CIRCUIT_FAILURES, WC_CIRCUIT_COOLDOWN)
+
+
+@app.errorhandler(WooCommerceUnavailableError)
+def handle_woocommerce_unavailable(error):
+    app.logger.error(f"WooCommerce unavailable: {error}")
+    return jsonify({'error': 'WooCommerce is unavailable, try again later'}), 503
+
+
+# ===================== Metrics and logging =====================
+
+# Per request lines (route, status, time, queries) are logged for a sample of the requests, slow and
+# failed requests always. LOG_LEVEL=DEBUG also logs a sample of the webhooks and of the SQL sent to WordPress.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))  # 1 logs every request
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+
+app.logger.setLevel(LOG_LEVEL)
+
+
+def log_sampled(level, message, *args):
+    # The arguments are only formatted when the line is actually written
+    if app.logger.isEnabledFor(level) and random.random() < LOG_SAMPLE_RATE:
+        app.logger.log(level, message, *args)
+
+
+class RequestMetrics:
+    """
+    Counters behind /api/metrics, kept by this process (with several workers each one is scraped
+    on its own). Routes are labelled by their URL rule, so /api/orders/Snack and /api/orders/Pub
+    share the series of /api/orders/<store_name>.
+    """
+
+    def __init__(self):
+        self.latency = {}  # (method, route) -> LatencyHistogram
+        self.responses = {}  # (method, route, status) -> count
+        self.db_queries = {}  # (method, route) -> WordPress queries made by those requests
+        self.db_seconds = {}  # (method, route) -> seconds spent in them
+        self.db_query_latency = LatencyHistogram()  # every query, requests and background workers alike
+        self.socket_clients = {}  # namespace -> connected Socket.IO clients
+        self._lock = threading.Lock()
+
+    def observe_request(self, method, route, status, seconds, db_queries, db_seconds):
+        histogram = self.latency.get((method, route))
+        if histogram is None:
+            histogram = self.latency.setdefault((method, route), LatencyHistogram())
+        histogram.observe(seconds)
+
+        with self._lock:
+            self.responses[(method, route, status)] = self.responses.get((method, route, status), 0) + 1
+            self.db_queries[(method, route)] = self.db_queries.get((method, route), 0) + db_queries
+            self.db_seconds[(method, route)] = self.db_seconds.get((method, route), 0.0) + db_seconds
+
+    def socket_connected(self, namespace, delta):
+        with self._lock:
+            self.socket_clients[namespace] = self.socket_clients.get(namespace, 0) + delta
+
+    def stats(self):
+        with self._lock:
+            return {
+                'responses': dict(self.responses),
+                'db_queries': dict(self.db_queries),
+                'db_seconds': dict(self.db_seconds),
+                'socket_clients': dict(self.socket_clients),
+            }
+
+
+request_metrics = RequestMetrics()
+
+
+def record_db_query(seconds):
+    request_metrics.db_query_latency.observe(seconds)
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_seconds += seconds
+
 
 @app.before_request
-def require_api_key():
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'  # 404s don't get a series per path
+    request_metrics.observe_request(request.method, route, response.status_code, seconds, g.db_queries, g.db_seconds)
+
+    message = "%s %s -> %s in %.1fms, %d queries (%.1fms)"
+    args = (request.method, request.path, response.status_code, seconds * 1000, g.db_queries, g.db_seconds * 1000)
+    if response.status_code >= 500 or seconds >= SLOW_REQUEST_SECONDS:
+        app.logger.warning(message, *args)
+    else:
+        log_sampled(logging.INFO, message, *args)
+    return response
+
+
+def prometheus_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}' if labels else ''
+
+
+def prometheus_histogram(lines, name, snapshot, **labels):
+    for bound, count in snapshot['buckets'].items():
+        lines.append(f"{name}_bucket{prometheus_labels(**labels, le=bound)} {count}")
+    lines.append(f"{name}_sum{prometheus_labels(**labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{prometheus_labels(**labels)} {snapshot['count']}")
+
+
+def prometheus_metrics():
+    lines = []
+
+    def header(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    stats = request_metrics.stats()
+    header('skipy_http_request_duration_seconds', 'histogram', 'Time to build the response, per route.')
+    for (method, route), histogram in list(request_metrics.latency.items()):
+        prometheus_histogram(lines, 'skipy_http_request_duration_seconds', histogram.snapshot(),
+                             method=method, route=route)
+    header('skipy_http_responses_total', 'counter', 'Responses sent, per route and status.')
+    for (method, route, status), count in stats['responses'].items():
+        labels = prometheus_labels(method=method, route=route, status=status)
+        lines.append(f"skipy_http_responses_total{labels} {count}")
+    header('skipy_http_request_db_queries_total', 'counter', 'WordPress queries made while handling the route.')
+    for (method, route), count in stats['db_queries'].items():
+        lines.append(f"skipy_http_request_db_queries_total{prometheus_labels(method=method, route=route)} {count}")
+    header('skipy_http_request_db_seconds_total', 'counter', 'Time in WordPress queries while handling the route.')
+    for (method, route), seconds in stats['db_seconds'].items():
+        lines.append(f"skipy_http_request_db_seconds_total{prometheus_labels(method=method, route=route)} {seconds}")
+
+    header('skipy_db_query_duration_seconds', 'histogram', 'Duration of every WordPress query.')
+    prometheus_histogram(lines, 'skipy_db_query_duration_seconds', request_metrics.db_query_latency.snapshot())
+    pool = db_pool.stats()
+    header('skipy_db_pool_connections', 'gauge', 'Connections of the WordPress pool by state.')
+    for state in ('open', 'in_use', 'idle', 'waiting'):
+        lines.append(f"skipy_db_pool_connections{prometheus_labels(state=state)} {pool[state]}")
+    header('skipy_db_pool_timeouts_total', 'counter', 'Checkouts that found no free connection in time.')
+    lines.append(f"skipy_db_pool_timeouts_total {pool['timeouts']}")
+
+    woocommerce = wc_client.stats()
+    header('skipy_woocommerce_request_duration_seconds', 'histogram', 'WooCommerce REST calls, per endpoint.')
+    for endpoint, snapshot in woocommerce['endpoints'].items():
+        prometheus_histogram(lines, 'skipy_woocommerce_request_duration_seconds', snapshot, endpoint=endpoint)
+    header('skipy_woocommerce_errors_total', 'counter', 'WooCommerce calls that failed or returned a 5xx.')
+    for endpoint, snapshot in woocommerce['endpoints'].items():
+        lines.append(f"skipy_woocommerce_errors_total{prometheus_labels(endpoint=endpoint)} {snapshot['errors']}")
+    header('skipy_woocommerce_circuit_open', 'gauge', '1 while calls to WooCommerce are cut off.')
+    lines.append(f"skipy_woocommerce_circuit_open {int(woocommerce['circuit'] == 'open')}")
+
+    with _order_cache_stats_lock:
+        caches = {f"orders:{family}": dict(family_stats) for family, family_stats in order_cache_stats.items()}
+    caches['users'] = user_cache.stats()
+    header('skipy_cache_hits_total', 'counter', 'Cache lookups answered from the cache.')
+    for name, cache_stats in caches.items():
+        lines.append(f"skipy_cache_hits_total{prometheus_labels(cache=name)} {cache_stats['hits']}")
+    header('skipy_cache_misses_total', 'counter', 'Cache lookups that had to load the data.')
+    for name, cache_stats in caches.items():
+        lines.append(f"skipy_cache_misses_total{prometheus_labels(cache=name)} {cache_stats['misses']}")
+    header('skipy_cache_hit_ratio', 'gauge', 'Hits over lookups since the process started.')
+    for name, cache_stats in caches.items():
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        lines.append(f"skipy_cache_hit_ratio{prometheus_labels(cache=name)} "
+                     f"{cache_stats['hits'] / lookups if lookups else 0.0}")
+
+    flights = order_flights.stats()
+    header('skipy_order_listing_requests_total', 'counter', 'Order listings by who loaded them (see SingleFlight).')
+    for outcome in ('loaded', 'collapsed', 'reused'):
+        lines.append(f"skipy_order_listing_requests_total{prometheus_labels(outcome=outcome)} {flights[outcome]}")
+
+    header('skipy_refunds', 'gauge', 'Refunds by state.')
+    for state, refunds in refund_stats().items():
+        lines.append(f"skipy_refunds{prometheus_labels(state=state)} {refunds}")
+
+    header('skipy_socketio_connected_clients', 'gauge', 'Socket.IO clients connected to this process.')
+    for namespace, clients in stats['socket_clients'].items():
+        lines.append(f"skipy_socketio_connected_clients{prometheus_labels(namespace=namespace)} {clients}")
+
+    header('skipy_status_outbox_pending', 'gauge', 'Status changes not pushed to WooCommerce yet.')
+    lines.append(f"skipy_status_outbox_pending {status_outbox_stats()['pending']}")
+
+    webhooks = webhook_inbox_stats()
+    header('skipy_webhooks_total', 'counter', 'Webhooks by what became of them.')
+    for outcome in ('received', 'duplicates', 'coalesced', 'processed', 'failed'):
+        lines.append(f"skipy_webhooks_total{prometheus_labels(outcome=outcome)} {webhooks[outcome]}")
+    header('skipy_webhook_inbox_pending', 'gauge', 'Webhooks acknowledged but not processed yet.')
+    lines.append(f"skipy_webhook_inbox_pending {webhooks['pending']}")
+    return '\n'.join(lines) + '\n'
+
+
+def is_open_endpoint():
+    # Requests served without the API key
     open_endpoints = ['/', '/api']
     if request.method == 'OPTIONS' or request.path in open_endpoints:
-        return  # Skip API key check for OPTIONS requests and open endpoints
+        return True
+    if request.path.startswith('/api/images/'):
+        return True  # resized product images, requested by img tags
+    if request.path == '/api/webhook' and WC_WEBHOOK_SECRET:
+        return True  # WooCommerce can't send the token, handle_webhook checks its signature instead
+    return False
+
 
-    auth_header = request.headers.get('Authorization')
+def has_api_token(auth_header):
+    # "Bearer <SEC_KEY>", from the Authorization header or the Socket.IO auth payload
     token = auth_header.split(" ")[1] if auth_header and ' ' in auth_header else None
+    return bool(token) and token == SEC_KEY
 
-    if not token or token != SEC_KEY:
+
+@app.before_request
+def require_api_key():
+    if is_open_endpoint():
+        return
+
+    if not has_api_token(request.headers.get('Authorization')):
         abort(403, description='Access denied')
 
 
+def current_user():
+    """
+    The tablets send the WordPress id of the logged in user in X-User-Id. The user's row is resolved on
+    first use in the request, from user_cache, and kept on g; None for anonymous callers. Only the routes
+    that default to the caller's shop ask for it, and a database error makes the caller anonymous.
+    """
+    if 'user' not in g:
+        g.user = None
+        user_id = request.headers.get('X-User-Id', '')
+        if user_id.isdigit():
+            try:
+                g.user = get_wordpress_user(int(user_id))
+            except (pymysql.err.MySQLError, PoolTimeoutError) as e:
+                app.logger.warning(f"Failed to resolve user {user_id}, treated as anonymous: {e}")
+    return g.user
+
+
+def caller_shop():
+    # The shop the caller works for, None for anonymous callers and users without a shop
+    user = current_user()
+    return user['shop_association'] if user else None
+
+
 @app.route('/api')
 def home():
-    print(f"####### ENDPOINT CALLED: /api on {datetime.now()}")
     return jsonify({'message': f'server running on {datetime.now()}'})
 
 
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    with _order_cache_stats_lock:
+        order_cache = {family: dict(stats) for family, stats in order_cache_stats.items()}
+    return jsonify({'db_pool': db_pool.stats(), 'order_cache': order_cache, 'woocommerce': wc_client.stats(),
+                    'status_outbox': status_outbox_stats(), 'user_cache': user_cache.stats(),
+                    'webhooks': webhook_inbox_stats(), 'order_single_flight': order_flights.stats(),
+                    'refunds': refund_stats()})
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format, scrape it with the same bearer token as the other endpoints
+    return Response(prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/webhook', methods=['POST'])
 def handle_webhook():
-    data = request.json
-    print("####### Received webhook wordpress data:", data)
+    # Only checked and queued here, WordPress gets its answer before any of the work (see webhook_worker)
+    body = request.get_data()
+    if WC_WEBHOOK_SECRET and not valid_webhook_signature(body, request.headers.get('X-WC-Webhook-Signature', '')):
+        abort(401, description='Invalid webhook signature')
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        # WooCommerce pings a new webhook with a form encoded webhook_id=<id>
+        return jsonify({"status": "ignored"}), 200
+    log_sampled(logging.DEBUG, "Received webhook wordpress data: %s", data)
+    topic = request.headers.get('X-WC-Webhook-Topic', '')
+    if is_order_webhook(topic, data) and not str(data.get('id', '')).isdigit():
+        # Nothing to apply it to, and an error would only make WooCommerce redeliver it
+        app.logger.warning(f"Webhook {topic} without an order id ignored")
+        return jsonify({"status": "ignored"}), 200
+
+    # WooCommerce redelivers when it thinks a delivery failed, the delivery id stays the same
+    delivery_id = request.headers.get('X-WC-Webhook-Delivery-ID')
+    delivery_key = f'webhook-delivery:{delivery_id}'
+    if delivery_id and not cache.add(delivery_key, 1, timeout=WEBHOOK_DEDUPE_TTL):
+        count_webhook('duplicates')
+        return jsonify({"status": "duplicate"}), 202
+
+    try:
+        queue_webhook(topic, data, body.decode('utf-8'))
+    except Exception:
+        # Not stored: WooCommerce gets the error and its redelivery must not be taken for a duplicate
+        if delivery_id:
+            cache.delete(delivery_key)
+        raise
+    return jsonify({"status": "accepted"}), 202
+
+
+def process_webhook(topic, data):
+    if is_order_webhook(topic, data):
+        previous = read_model_order_status(data.get('id'))
+        order = sync_order_change(previous, data, topic)
+        # The clients get the order in the same shape as the listings instead of the raw payload
+        publish_order_delta('order_delta', int(data['id']), order, previous[0] if previous else None)
+        return
+
+    if topic == 'product.deleted':
+        product_catalogue.remove(data.get('id'))
+    elif topic.startswith('product.'):
+        product_catalogue.put(data)
+    elif topic.startswith('customer.'):
+        # WooCommerce customers are the WordPress users, their role or shop may have changed
+        user_cache.delete(data.get('id'))
 
     # Emit the data to all connected clients
     socketio.emit('webhook_received', data)
 
-    return jsonify({"status": "success"}), 200
 
+def filter_orders_by_store(store_name, status):
+    # There is no orders_table: the orders of a store are read from the order storage like every listing
+    return get_orders_by_status(status, store_name)
 
-def update_order_status(order_id, status):
-    url = f"{WC_API_URL}/orders/{order_id}"
-    data = {'status': status}
-    response = requests.put(url, auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET), json=data)
 
-    if response.ok:
-        print("####### Order status updated successfully.")
-        return response.json()
-    else:
-        print(f"####### Failed to update order status: {response.text}")
-        return None
+# Statuses shown on the kitchen screens, in the order an order goes through them
+OPEN_ORDER_STATUSES = ('wc-processing', 'wc-preparing', 'wc-ready')
 
 
-def filter_orders_by_store(store_name, status):
-    # Establish database connection
-    connection = pymysql.connect(host='localhost',
-                                 user='wordpress',
-                                 password='admin123',
-                                 database='wordpress',
-                                 cursorclass=pymysql.cursors.DictCursor)
-
-    filtered_orders = []
+def normalize_statuses(status):
+    """
+    Turn a status, a comma separated list of statuses or a collection of statuses into a tuple of
+    WordPress post statuses. 'processing' and 'wc-processing' are the same, 'open' is every open status.
+    """
+    if not status:
+        return ()
+    if isinstance(status, str):
+        status = status.split(',')
+
+    statuses = []
+    for name in status:
+        name = name.strip().lower()
+        if not name:
+            continue
+        expanded = OPEN_ORDER_STATUSES if name == 'open' else (name if name.startswith('wc-') else f'wc-{name}',)
+        statuses.extend(s for s in expanded if s not in statuses)
+    return tuple(statuses)
+
+
+# Max number of orders in one page of ?limit=
+ORDER_PAGE_MAX_LIMIT = 500
+
+# Order row columns each field of simplify_order_structure is built from, for ?fields=
+ORDER_FIELD_COLUMNS = {
+    'ORDER_ID': ('order_id',),
+    'USER_NAME': ('billing_first_name', 'billing_last_name'),
+    'EMAIL': ('billing_email',),
+    'PHONE': ('billing_phone',),
+    'DATE': ('date_created',),
+    'STATUS': ('status',),
+    'SHOP': ('store_name',),
+    'TOTAL': ('total',),
+    'PAYMENT_METHOD': ('payment_method_title',),
+    'PRODUCTS': (),
+}
+
+
+def parse_order_window(args):
+    """
+    Read the paging and projection parameters of the /api/orders routes:
+    ?after=<order id>&limit=<n> (keyset pagination on the order id, in the sort order of the listing),
+    ?date_from=&date_to= (ISO dates, on the order date, date_to excluded) and ?fields=ORDER_ID,STATUS,...
+    Returns None when none is given (whole listing), a dict, or an error response tuple.
+    """
+    if not any(args.get(name) for name in ('after', 'limit', 'date_from', 'date_to', 'fields')):
+        return None
     try:
+        after = int(args['after']) if args.get('after') else None
+        limit = min(int(args['limit']), ORDER_PAGE_MAX_LIMIT) if args.get('limit') else None
+        date_from = datetime.fromisoformat(args['date_from']) if args.get('date_from') else None
+        date_to = datetime.fromisoformat(args['date_to']) if args.get('date_to') else None
+    except ValueError as e:
+        return jsonify({'error': f'Invalid paging parameter: {e}'}), 400
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    fields = None
+    if args.get('fields'):
+        fields = tuple(field.strip().upper() for field in args['fields'].split(',') if field.strip())
+        unknown = [field for field in fields if field not in ORDER_FIELD_COLUMNS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields {', '.join(unknown)}"}), 400
+        if 'ORDER_ID' not in fields:
+            fields = ('ORDER_ID',) + fields  # the cursor of the next page
+
+    return {'after': after, 'limit': limit, 'date_from': date_from, 'date_to': date_to, 'fields': fields}
+
+
+def order_window_columns(window):
+    # Order row columns needed for the fields of a window, all of them without a projection
+    if not window or not window['fields']:
+        return ORDER_READ_MODEL_FIELDS
+    return tuple(column for column in ORDER_READ_MODEL_FIELDS
+                 if any(column in ORDER_FIELD_COLUMNS[field] for field in window['fields']))
+
+
+def wants_products(window):
+    return not window or not window['fields'] or 'PRODUCTS' in window['fields']
+
+
+def project_order(order, products, window):
+    # simplify_order_structure restricted to the requested fields
+    if not window or not window['fields']:
+        return simplify_order_structure(order, products)
+    simplified = simplify_order_structure(dict.fromkeys(ORDER_READ_MODEL_FIELDS) | order, products)
+    return {field: simplified[field] for field in window['fields']}
+
+
+def get_orders_by_status(status, store_name=None, sort='ASC', window=None):
+    # status can be a single status or several of them, which are all fetched by the same query
+    statuses = normalize_statuses(status)
+    if read_model_ready():
+        return read_model_get_orders(statuses, store_name, sort, window=window)
+    return fetch_orders_from_wordpress(statuses, store_name, sort, window=window)
+
+
+def load_order(order_id):
+    # A single order in the simplified shape, or None when it doesn't exist
+    if read_model_ready():
+        orders = read_model_get_orders((), order_ids=[order_id])
+    else:
+        orders = fetch_orders_from_wordpress((), order_ids=[order_id])
+    return orders[0] if orders else None
+
+
+def fetch_orders_from_wordpress(statuses, store_name=None, sort='ASC', order_ids=None, window=None):
+    # Build the orders from the WordPress posts/postmeta tables
+    with db_connection() as connection:
         with connection.cursor() as cursor:
-            # Construct the query to fetch orders for a specific store and status
-            query = "SELECT * FROM orders_table WHERE status = %s AND store_name = %s"  # TODO orders_table exist???
-            params = [status, store_name]
+            orders, products_by_order = query_wordpress_orders(cursor, statuses, store_name, sort, order_ids, window)
 
-            # Execute the query
-            cursor.execute(query, params)
-            orders = cursor.fetchall()
+    # Simplify each order's structure
+    return [project_order(order, products_by_order.get(order['order_id'], []), window) for order in orders]
 
-            # Simplify the order data structure (if necessary)
-            for order in orders:
-                simplified_order = simplify_order_structure(cursor, order)  # Define or adjust this function as needed
-                filtered_orders.append(simplified_order)
-    finally:
-        connection.close()
 
-    return filtered_orders
+# wp_postmeta key of each order column that isn't in wp_posts
+ORDER_META_KEYS = {
+    'billing_first_name': '_billing_first_name',
+    'billing_last_name': '_billing_last_name',
+    'billing_email': '_billing_email',
+    'billing_phone': '_billing_phone',
+    'total': '_order_total',
+    'store_name': 'store_name',
+    'payment_method_title': '_payment_method_title',
+}
+
 
+def query_wordpress_orders(cursor, statuses, store_name=None, sort='ASC', order_ids=None, window=None):
+    """
+    Returns the raw order rows and their products grouped by order_id. With a window (see
+    parse_order_window) only that page and the meta of the requested fields are read.
+    """
+    storage = order_storage(cursor)
+    tz = order_dates_timezone(cursor, storage)
+    base_query, params = storage.build_orders_query(statuses, store_name, sort, order_ids, window_to_gmt(window, tz))
+
+    log_sampled(logging.DEBUG, "query_wordpress_orders store=%s statuses=%s params=%s\n%s",
+                store_name, ', '.join(statuses), params, base_query)
+
+    # Execute the query
+    cursor.execute(base_query, params)
+    orders = rows_to_site_time(cursor.fetchall(), tz)
+
+    # Load the products of all the orders at once
+    products_by_order = {}
+    if wants_products(window):
+        products_by_order = fetch_products_for_orders(cursor, [order['order_id'] for order in orders])
+    return orders, products_by_order
+
+
+def build_wordpress_orders_query(statuses, store_name=None, sort='ASC', order_ids=None, window=None):
+    # The pivot query of query_wordpress_orders and its parameters
+    meta_columns = [column for column in order_window_columns(window) if column in ORDER_META_KEYS]
+    base_query = "SELECT p.ID as order_id, p.post_date as date_created, p.post_status as status"
+    for column in meta_columns:
+        base_query += f",\n max(case when pm.meta_key = '{ORDER_META_KEYS[column]}' then pm.meta_value end) as {column}"
+    base_query += "\n FROM wp_posts p "
+    if meta_columns:
+        meta_keys = ', '.join(f"'{ORDER_META_KEYS[column]}'" for column in meta_columns)
+        base_query += f"\n LEFT JOIN wp_postmeta pm ON p.ID = pm.post_id AND pm.meta_key IN ({meta_keys}) "
+    base_query += "\n WHERE p.post_type = 'shop_order' "
+
+    if statuses:
+        base_query += f" AND p.post_status IN ({', '.join(['%s'] * len(statuses))}) "
+        params = list(statuses)
+    else:
+        params = []
+
+    if order_ids:
+        base_query += f" AND p.ID IN ({', '.join(['%s'] * len(order_ids))}) "
+        params.extend(order_ids)
+
+    if store_name:
+        # base_query += " AND max(case when pm.meta_key = 'store_name' then pm.meta_value end) = %s"
+        # base_query += " AND pm.meta_key = 'store_name' AND pm.meta_value = %s"
+        base_query += (" AND p.ID IN "
+                       "  (SELECT pm1.post_id FROM wp_postmeta pm1 "
+                       "    WHERE pm1.meta_key = 'store_name' AND pm1.meta_value = %s ) ")
+        params.append(store_name)
+
+    if window:
+        # Keyset pagination: the next page starts after the last order id of the previous one
+        if window['after'] is not None:
+            base_query += " AND p.ID > %s " if sort == 'ASC' else " AND p.ID < %s "
+            params.append(window['after'])
+        if window['date_from']:
+            base_query += " AND p.post_date >= %s "
+            params.append(window['date_from'])
+        if window['date_to']:
+            base_query += " AND p.post_date < %s "
+            params.append(window['date_to'])
+
+    base_query += " GROUP BY p.ID "
+    base_query += f" ORDER BY p.ID {sort} "
+    if window and window['limit']:
+        base_query += " LIMIT %s "
+        params.append(window['limit'])
+
+    return base_query, params
+
+
+# ===================== Order storage =====================
+
+# WooCommerce keeps the orders either in wp_posts/wp_postmeta or, with High-Performance Order Storage,
+# in flat indexed tables (wp_wc_orders, wp_wc_order_addresses, wp_wc_orders_meta). Both give the same
+# order rows; the line items are in wp_woocommerce_order_items either way.
+ORDER_STORAGE = os.environ.get('ORDER_STORAGE', 'auto')  # auto, hpos or posts
+ORDER_STORAGE_CHECK_INTERVAL = 300  # seconds, HPOS can be switched on and off from the WooCommerce settings
+
+# gmt_dates: the date_created of its rows (and so the date filters) are GMT instead of site time
+OrderStorage = namedtuple('OrderStorage', 'name build_orders_query stripe_charge_query order_ids_query '
+                                           'changed_orders_query gmt_dates')
+
+# WooCommerce stores order meta in the wp_postmeta table. Adjust meta_key as needed.
+STRIPE_CHARGE_QUERY = """
+    SELECT meta_value AS stripe_charge_id
+    FROM wp_postmeta
+    WHERE post_id = %s AND meta_key = '_transaction_id'
+"""
+
+# wp_wc_order_addresses column of each order column
+HPOS_ADDRESS_COLUMNS = {
+    'billing_first_name': 'first_name',
+    'billing_last_name': 'last_name',
+    'billing_email': 'email',
+    'billing_phone': 'phone',
+}
 
-def get_orders_by_status(status, store_name=None, sort='ASC'):
-    # Database connection
-    connection = pymysql.connect(host='localhost', user='wordpress', password='admin123', database='wordpress',
-                                 cursorclass=pymysql.cursors.DictCursor)
-    all_orders = []
-    try:
-        with connection.cursor() as cursor:
-            base_query = """
-            SELECT p.ID as order_id, p.post_date as date_created, p.post_status as status,
-                   max(case when pm.meta_key = '_billing_first_name' then pm.meta_value end) as billing_first_name,
-                   max(case when pm.meta_key = '_billing_last_name' then pm.meta_value end) as billing_last_name,
-                   max(case when pm.meta_key = '_billing_email' then pm.meta_value end) as billing_email,
-                   max(case when pm.meta_key = '_billing_phone' then pm.meta_value end) as billing_phone,
-                   max(case when pm.meta_key = '_order_total' then pm.meta_value end) as total,
-                   max(case when pm.meta_key = 'store_name' then pm.meta_value end) as store_name,
-                   max(case when pm.meta_key = '_payment_method_title' then pm.meta_value end) as payment_method_title
-            FROM wp_posts p
-            LEFT JOIN wp_postmeta pm ON p.ID = pm.post_id
-            WHERE p.post_type = 'shop_order'
-            """
-
-            if status:
-                base_query += " AND p.post_status = %s "
-                params = [status]
-            else:
-                params = []
-
-            if store_name:
-                # base_query += " AND max(case when pm.meta_key = 'store_name' then pm.meta_value end) = %s"
-                # base_query += " AND pm.meta_key = 'store_name' AND pm.meta_value = %s"
-                base_query += (" AND pm.post_id IN "
-                               "  (SELECT pm1.post_id FROM wp_postmeta pm1 "
-                               "    WHERE pm1.meta_key = 'store_name' AND pm1.meta_value = %s ) ")
-                params.append(store_name)
-
-            base_query += " GROUP BY p.ID "
-            base_query += f" ORDER BY p.ID {sort} "
-
-            print("\n################# RUNNING QUERY: get_orders_by_status ################")
-            print(f"####### CALLED: {datetime.now()}")
-            print(f"####### STORE: {store_name}")
-            print(f"####### STATUS: {status}")
-            print(f"####### PARAMETERS:{params}")
-            print(f"####### BASE QUERY:{base_query}")
-            print("############################ END OF QUERY ############################\n")
-
-            # Execute the query
-            cursor.execute(base_query, params)
-            orders = cursor.fetchall()
-
-            # Simplify each order's structure
-            for order in orders:
-                simplified_order = simplify_order_structure(cursor, order)
-                all_orders.append(simplified_order)
 
-    finally:
-        connection.close()
+def build_hpos_orders_query(statuses, store_name=None, sort='ASC', order_ids=None, window=None):
+    """
+    Same rows as build_wordpress_orders_query, from the HPOS tables. Everything but the store is a
+    column there, so there is nothing to pivot. HPOS only has date_created_gmt: the dates of the window
+    must be GMT and the rows are converted to site time afterwards (see order_dates_timezone).
+    """
+    columns = order_window_columns(window)
+    address_columns = [column for column in columns if column in HPOS_ADDRESS_COLUMNS]
+    select = ["o.id as order_id", "o.date_created_gmt as date_created", "o.status as status"]
+    select += [f"a.{HPOS_ADDRESS_COLUMNS[column]} as {column}" for column in address_columns]
+    if 'total' in columns:
+        select.append("CAST(o.total_amount AS CHAR) as total")
+    if 'store_name' in columns:
+        select.append("sm.meta_value as store_name")
+    if 'payment_method_title' in columns:
+        select.append("o.payment_method_title as payment_method_title")
+
+    base_query = f"SELECT {', '.join(select)}\n FROM wp_wc_orders o "
+    if address_columns:
+        base_query += "\n LEFT JOIN wp_wc_order_addresses a ON a.order_id = o.id AND a.address_type = 'billing' "
+    if 'store_name' in columns or store_name:
+        base_query += "\n LEFT JOIN wp_wc_orders_meta sm ON sm.order_id = o.id AND sm.meta_key = 'store_name' "
+    base_query += "\n WHERE o.type = 'shop_order' "
+    params = []
+
+    if statuses:
+        base_query += f" AND o.status IN ({', '.join(['%s'] * len(statuses))}) "
+        params.extend(statuses)
+    if order_ids:
+        base_query += f" AND o.id IN ({', '.join(['%s'] * len(order_ids))}) "
+        params.extend(order_ids)
+    if store_name:
+        base_query += " AND sm.meta_value = %s "
+        params.append(store_name)
+    if window:
+        if window['after'] is not None:
+            base_query += " AND o.id > %s " if sort == 'ASC' else " AND o.id < %s "
+            params.append(window['after'])
+        if window['date_from']:
+            base_query += " AND o.date_created_gmt >= %s "
+            params.append(window['date_from'])
+        if window['date_to']:
+            base_query += " AND o.date_created_gmt < %s "
+            params.append(window['date_to'])
+
+    base_query += f" ORDER BY o.id {sort} "
+    if window and window['limit']:
+        base_query += " LIMIT %s "
+        params.append(window['limit'])
+    return base_query, params
+
+
+def build_wordpress_changed_orders_query(store_name, after, until, limit):
+    """
+    Ids and modification dates of the orders changed after the (post_modified_gmt, ID) keyset `after`
+    and up to `until`, oldest change first. The range on post_modified_gmt is the leading condition
+    so it can be read from the skipy_posts_type_modified index (see WORDPRESS_INDEXES). Used by
+    get_order_changes.
+    """
+    modified, order_id = after
+    base_query = ("SELECT p.ID as order_id, p.post_modified_gmt as modified FROM wp_posts p "
+                  "WHERE p.post_type = 'shop_order' AND p.post_modified_gmt >= %s AND p.post_modified_gmt <= %s "
+                  "AND (p.post_modified_gmt > %s OR p.ID > %s) ")
+    params = [modified, until, modified, order_id]
+    if store_name:
+        base_query += ("AND p.ID IN (SELECT pm1.post_id FROM wp_postmeta pm1 "
+                       "WHERE pm1.meta_key = 'store_name' AND pm1.meta_value = %s) ")
+        params.append(store_name)
+    base_query += "ORDER BY p.post_modified_gmt, p.ID LIMIT %s"
+    params.append(limit)
+    return base_query, params
+
+
+def build_hpos_changed_orders_query(store_name, after, until, limit):
+    # Same as build_wordpress_changed_orders_query, through the date_updated index of wp_wc_orders
+    modified, order_id = after
+    base_query = "SELECT o.id as order_id, o.date_updated_gmt as modified FROM wp_wc_orders o "
+    if store_name:
+        base_query += "JOIN wp_wc_orders_meta sm ON sm.order_id = o.id AND sm.meta_key = 'store_name' "
+    base_query += ("WHERE o.type = 'shop_order' AND o.date_updated_gmt >= %s AND o.date_updated_gmt <= %s "
+                   "AND (o.date_updated_gmt > %s OR o.id > %s) ")
+    params = [modified, until, modified, order_id]
+    if store_name:
+        base_query += "AND sm.meta_value = %s "
+        params.append(store_name)
+    base_query += "ORDER BY o.date_updated_gmt, o.id LIMIT %s"
+    params.append(limit)
+    return base_query, params
+
+
+POSTS_ORDER_STORAGE = OrderStorage(
+    'posts', build_wordpress_orders_query, STRIPE_CHARGE_QUERY,
+    "SELECT ID FROM wp_posts WHERE post_type = 'shop_order' ORDER BY ID DESC LIMIT 100",
+    build_wordpress_changed_orders_query, False)
+HPOS_ORDER_STORAGE = OrderStorage(
+    'hpos', build_hpos_orders_query,
+    "SELECT transaction_id AS stripe_charge_id FROM wp_wc_orders WHERE id = %s",
+    "SELECT id AS ID FROM wp_wc_orders WHERE type = 'shop_order' ORDER BY id DESC LIMIT 100",
+    build_hpos_changed_orders_query, True)
+
+_order_storage = None
+_order_storage_checked_at = 0.0
+
+
+def order_storage(cursor):
+    """
+    The storage the orders are read from: ORDER_STORAGE when forced, otherwise HPOS when WooCommerce
+    has it enabled as the authoritative storage (with sync on, wp_posts only holds placeholders).
+    """
+    global _order_storage, _order_storage_checked_at
+    if ORDER_STORAGE in ('hpos', 'posts'):
+        return HPOS_ORDER_STORAGE if ORDER_STORAGE == 'hpos' else POSTS_ORDER_STORAGE
+    if _order_storage is None or time.monotonic() - _order_storage_checked_at > ORDER_STORAGE_CHECK_INTERVAL:
+        try:
+            cursor.execute("SELECT option_value FROM wp_options "
+                           "WHERE option_name = 'woocommerce_custom_orders_table_enabled'")
+            option = cursor.fetchone()
+            storage = HPOS_ORDER_STORAGE if option and option['option_value'] == 'yes' else POSTS_ORDER_STORAGE
+        except pymysql.err.ProgrammingError:
+            storage = POSTS_ORDER_STORAGE  # no wp_options table, not a WordPress database we know
+        if storage is not _order_storage:
+            app.logger.info(f"Reading orders from the {storage.name} storage")
+        _order_storage, _order_storage_checked_at = storage, time.monotonic()
+    return _order_storage
 
-    return all_orders
+
+_site_timezone = None
+_site_timezone_checked_at = 0.0
+
+
+def site_timezone(cursor):
+    """
+    The timezone of the WordPress site (Settings > General): post_date, the webhooks and the REST API
+    give the order dates in it. A named zone in timezone_string, otherwise a fixed gmt_offset in hours.
+    """
+    global _site_timezone, _site_timezone_checked_at
+    if _site_timezone is None or time.monotonic() - _site_timezone_checked_at > ORDER_STORAGE_CHECK_INTERVAL:
+        cursor.execute("SELECT option_name, option_value FROM wp_options "
+                       "WHERE option_name IN ('timezone_string', 'gmt_offset')")
+        options = {row['option_name']: row['option_value'] for row in cursor.fetchall()}
+        tz = None
+        if options.get('timezone_string'):
+            try:
+                tz = ZoneInfo(options['timezone_string'])
+            except (ZoneInfoNotFoundError, ValueError):
+                app.logger.warning(f"Unknown site timezone {options['timezone_string']}, using gmt_offset")
+        if tz is None:
+            try:
+                tz = timezone(timedelta(hours=float(options.get('gmt_offset') or 0)))
+            except ValueError:
+                tz = timezone.utc
+        _site_timezone, _site_timezone_checked_at = tz, time.monotonic()
+    return _site_timezone
+
+
+def order_dates_timezone(cursor, storage):
+    # The site timezone when the storage's dates are GMT, None when they already are site time
+    return site_timezone(cursor) if storage.gmt_dates else None
+
+
+def window_to_gmt(window, tz):
+    # ?date_from=/date_to= are site time, like post_date. With a GMT storage they are converted first.
+    if not tz or not window or not (window['date_from'] or window['date_to']):
+        return window
+
+    def to_gmt(date):
+        if date is None:
+            return None
+        date = date if date.tzinfo else date.replace(tzinfo=tz)
+        return date.astimezone(timezone.utc).replace(tzinfo=None)
+    return dict(window, date_from=to_gmt(window['date_from']), date_to=to_gmt(window['date_to']))
+
+
+def rows_to_site_time(orders, tz):
+    # date_created of the rows of a GMT storage, in site time like the posts storage gives it
+    if tz:
+        for order in orders:
+            if isinstance(order.get('date_created'), datetime):
+                order['date_created'] = (order['date_created'].replace(tzinfo=timezone.utc)
+                                         .astimezone(tz).replace(tzinfo=None))
+    return orders
 
 
 def get_total_from_order(order):
@@ -183,7 +1343,7 @@ def get_total_from_order(order):
     return total_value
 
 
-def simplify_order_structure(cursor, order):
+def simplify_order_structure(order, products=None):
     # Simplify the order structure
     simplified_order = {
         'ORDER_ID': order['order_id'],
@@ -195,170 +1355,1075 @@ def simplify_order_structure(cursor, order):
         'SHOP': order['store_name'],
         'TOTAL': get_total_from_order(order),  # float(order['total']),
         'PAYMENT_METHOD': order.get('payment_method_title', 'No payment method provided'),
-        'PRODUCTS': []  # Initialize an empty list for products
+        'PRODUCTS': products if products is not None else []
     }
 
-    # Fetch and append product details
-    # TODO nao fazer busca extra no futuro, tudo na query principal
-    fetch_products_for_order(cursor, simplified_order['ORDER_ID'], simplified_order['PRODUCTS'])
-
     return simplified_order
 
 
-# TODO englobar toda esta funcao/queries na query principal por questao de performance
-def fetch_products_for_order(cursor, order_id, products_list):
-    # Query to get all product IDs, quantities, and line totals (price) associated with the order
-    product_query = """
-    SELECT order_item_id, order_item_name
-    FROM wp_woocommerce_order_items
-    WHERE order_id = %s AND order_item_type = 'line_item'
-    """
-    cursor.execute(product_query, (order_id,))
-    order_items = cursor.fetchall()
-
-    # For each item, fetch associated product details including the product price
-    for item in order_items:
-        # Get product ID and quantity
-        product_id_query = """
-        SELECT meta_value
-        FROM wp_woocommerce_order_itemmeta
-        WHERE order_item_id = %s AND meta_key = '_product_id'
-        """
-        cursor.execute(product_id_query, (item['order_item_id'],))
-        product_id_result = cursor.fetchone()
-        product_id = product_id_result['meta_value'] if product_id_result else 'Unknown'
-
-        quantity_query = """
-        SELECT meta_value
-        FROM wp_woocommerce_order_itemmeta
-        WHERE order_item_id = %s AND meta_key = '_qty'
-        """
-        cursor.execute(quantity_query, (item['order_item_id'],))
-        quantity_result = cursor.fetchone()
-        quantity = quantity_result['meta_value'] if quantity_result else '0'
-
-        # Get product price (line total)
-        price_query = """
-        SELECT meta_value
-        FROM wp_woocommerce_order_itemmeta
-        WHERE order_item_id = %s AND meta_key = '_line_total'
-        """
-        cursor.execute(price_query, (item['order_item_id'],))
-        price_result = cursor.fetchone()
-        price = price_result['meta_value'] if price_result else '0.00'
-
-        # Construct the product object with id, name, quantity, and price, then append it to the list
-        product = {
-            'id': product_id,
-            'name': item['order_item_name'],
-            'quantity': quantity,
-            'price': price
-        }
-        products_list.append(product)
+# Max number of orders sent in a single IN (...) when loading line items
+ORDER_ITEMS_CHUNK_SIZE = 1000
+
+
+def fetch_products_for_orders(cursor, order_ids):
+    """
+    Load the products of many orders at once, grouped by order_id.
+
+    The line items and their _product_id, _qty and _line_total meta are pivoted in a single
+    query per chunk of orders, instead of 1 query per order plus 3 per line item.
+    """
+    products_by_order = {}
+    order_ids = list(order_ids)
+
+    for start in range(0, len(order_ids), ORDER_ITEMS_CHUNK_SIZE):
+        chunk = order_ids[start:start + ORDER_ITEMS_CHUNK_SIZE]
+        cursor.execute(*build_order_items_query(chunk))
+
+        for item in cursor.fetchall():
+            # Same defaults as when each meta was fetched on its own
+            product = {
+                'id': item['product_id'] if item['product_id'] is not None else 'Unknown',
+                'name': item['order_item_name'],
+                'quantity': item['quantity'] if item['quantity'] is not None else '0',
+                'price': item['price'] if item['price'] is not None else '0.00'
+            }
+            products_by_order.setdefault(item['order_id'], []).append(product)
+
+    return products_by_order
+
+
+def build_order_items_query(order_ids):
+    placeholders = ', '.join(['%s'] * len(order_ids))
+    product_query = f"""
+    SELECT oi.order_id, oi.order_item_id, oi.order_item_name,
+           max(case when oim.meta_key = '_product_id' then oim.meta_value end) as product_id,
+           max(case when oim.meta_key = '_qty' then oim.meta_value end) as quantity,
+           max(case when oim.meta_key = '_line_total' then oim.meta_value end) as price
+    FROM wp_woocommerce_order_items oi
+    LEFT JOIN wp_woocommerce_order_itemmeta oim
+           ON oi.order_item_id = oim.order_item_id
+          AND oim.meta_key IN ('_product_id', '_qty', '_line_total')
+    WHERE oi.order_id IN ({placeholders}) AND oi.order_item_type = 'line_item'
+    GROUP BY oi.order_item_id
+    ORDER BY oi.order_item_id
+    """
+    return product_query, list(order_ids)
+
+
+# ===================== Order read model =====================
+
+# Flat, indexed copy of the orders kept in the local database. It is filled by
+# `flask rebuild-order-read-model` and then kept up to date by the webhook and the status routes,
+# so listing orders no longer pivots wp_postmeta on every call.
+ORDER_READ_MODEL_ENABLED = os.environ.get('ORDER_READ_MODEL_ENABLED', '1') == '1'
+
+# Columns of the orders table, same names as the rows returned by query_wordpress_orders
+ORDER_READ_MODEL_FIELDS = ('order_id', 'date_created', 'status', 'billing_first_name', 'billing_last_name',
+                           'billing_email', 'billing_phone', 'total', 'store_name', 'payment_method_title')
+
+# Max number of ? parameters sent to SQLite in a single IN (...)
+LOCAL_DB_CHUNK_SIZE = 500
+
+_read_model_ready = False
+
+
+def read_model_ready():
+    # The read model is only used for reads once it has been rebuilt at least once
+    global _read_model_ready
+    if not ORDER_READ_MODEL_ENABLED:
+        return False
+    if not _read_model_ready:
+        row = local_db().execute("SELECT value FROM local_meta WHERE key = 'orders_rebuilt_at'").fetchone()
+        _read_model_ready = row is not None
+    return _read_model_ready
+
+
+def read_model_upsert_orders(orders, projected_at=None):
+    """
+    Insert or update orders, given as (order row, products) pairs.
+
+    An order that was projected after `projected_at` is left untouched, so a rebuild can't
+    overwrite a newer webhook update. Returns the number of orders written.
+    """
+    projected_at = projected_at or time.time()
+    columns = ', '.join(ORDER_READ_MODEL_FIELDS)
+    placeholders = ', '.join(['?'] * (len(ORDER_READ_MODEL_FIELDS) + 1))
+    updates = ', '.join(f'{field} = excluded.{field}' for field in ORDER_READ_MODEL_FIELDS[1:])
+    upsert_query = f"""
+        INSERT INTO orders ({columns}, projected_at) VALUES ({placeholders})
+        ON CONFLICT (order_id) DO UPDATE SET {updates}, projected_at = excluded.projected_at
+        WHERE orders.projected_at <= excluded.projected_at
+    """
+
+    written = 0
+    with local_transaction() as connection:
+        for order, products in orders:
+            values = [order.get(field) for field in ORDER_READ_MODEL_FIELDS]
+            if isinstance(order.get('date_created'), datetime):
+                values[1] = order['date_created'].isoformat(sep=' ')
+
+            if connection.execute(upsert_query, values + [projected_at]).rowcount == 0:
+                continue  # a newer version is already projected
+
+            connection.execute("DELETE FROM order_items WHERE order_id = ?", (order['order_id'],))
+            connection.executemany(
+                "INSERT INTO order_items (order_id, position, product_id, name, quantity, price) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(order['order_id'], position, product['id'], product['name'], product['quantity'], product['price'])
+                 for position, product in enumerate(products)])
+            written += 1
+
+    return written
+
+
+def read_model_order_status(order_id):
+    # (store_name, status) of an order as last projected, None when the read model doesn't know it
+    if not ORDER_READ_MODEL_ENABLED or order_id is None:
+        return None
+    row = local_db().execute("SELECT store_name, status FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+    return (row['store_name'], row['status']) if row else None
+
+
+def read_model_delete_order(order_id):
+    with local_transaction() as connection:
+        connection.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,))
+        connection.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+
+
+def read_model_get_orders(statuses, store_name=None, sort='ASC', order_ids=None, window=None):
+    # Same result as fetch_orders_from_wordpress, read from the local read model
+    query, params = build_read_model_orders_query(statuses, store_name, sort, order_ids, window)
+    connection = local_db()
+    orders = [read_model_order_row(row) for row in connection.execute(query, params)]
+
+    products_by_order = {}
+    if wants_products(window):
+        products_by_order = read_model_products(connection, [order['order_id'] for order in orders])
+    return [project_order(order, products_by_order.get(order['order_id'], []), window) for order in orders]
+
+
+def read_model_order_row(row):
+    order = dict(row)
+    if order.get('date_created'):
+        order['date_created'] = datetime.fromisoformat(order['date_created'])
+    return order
+
+
+def build_read_model_orders_query(statuses, store_name=None, sort='ASC', order_ids=None, window=None):
+    query = f"SELECT {', '.join(order_window_columns(window))} FROM orders WHERE 1 = 1"
+    params = []
+    if order_ids:
+        query += f" AND order_id IN ({', '.join(['?'] * len(order_ids))})"
+        params.extend(order_ids)
+    if statuses:
+        query += f" AND status IN ({', '.join(['?'] * len(statuses))})"
+        params.extend(statuses)
+    if store_name:
+        query += " AND store_name = ?"
+        params.append(store_name)
+    if window:
+        if window['after'] is not None:
+            query += " AND order_id > ?" if sort == 'ASC' else " AND order_id < ?"
+            params.append(window['after'])
+        if window['date_from']:
+            query += " AND date_created >= ?"
+            params.append(window['date_from'].isoformat(sep=' '))
+        if window['date_to']:
+            query += " AND date_created < ?"
+            params.append(window['date_to'].isoformat(sep=' '))
+    query += f" ORDER BY order_id {sort}"
+    if window and window['limit']:
+        query += " LIMIT ?"
+        params.append(window['limit'])
+    return query, params
+
+
+def read_model_products(connection, order_ids):
+    products_by_order = {}
+    for start in range(0, len(order_ids), LOCAL_DB_CHUNK_SIZE):
+        chunk = order_ids[start:start + LOCAL_DB_CHUNK_SIZE]
+        rows = connection.execute(
+            f"SELECT * FROM order_items WHERE order_id IN ({', '.join(['?'] * len(chunk))}) "
+            f"ORDER BY order_id, position", chunk)
+        for row in rows:
+            products_by_order.setdefault(row['order_id'], []).append({
+                'id': row['product_id'],
+                'name': row['name'],
+                'quantity': row['quantity'],
+                'price': row['price']
+            })
+    return products_by_order
+
+
+def order_from_wc_payload(data):
+    """
+    Turn an order from the WooCommerce REST API (PUT responses and webhooks use the same format)
+    into an order row and its products, in the same shape as query_wordpress_orders.
+    """
+    billing = data.get('billing') or {}
+    meta = {meta_data.get('key'): meta_data.get('value') for meta_data in data.get('meta_data') or []}
+    status = data.get('status') or ''
+    date_created = data.get('date_created')
+
+    order = {
+        'order_id': int(data['id']),
+        'date_created': datetime.fromisoformat(date_created) if date_created else None,
+        'status': status if status.startswith('wc-') else f'wc-{status}',
+        'billing_first_name': billing.get('first_name'),
+        'billing_last_name': billing.get('last_name'),
+        'billing_email': billing.get('email'),
+        'billing_phone': billing.get('phone'),
+        'total': data.get('total'),
+        'store_name': meta.get('store_name'),
+        'payment_method_title': data.get('payment_method_title'),
+    }
+    products = [{
+        'id': str(item['product_id']) if item.get('product_id') is not None else 'Unknown',
+        'name': item.get('name'),
+        'quantity': str(item.get('quantity', 0)),
+        'price': item.get('total', '0.00')
+    } for item in data.get('line_items') or []]
+
+    return order, products
+
+
+def is_order_webhook(topic, data):
+    if topic:
+        return topic.startswith('order.')
+    return isinstance(data, dict) and 'id' in data and 'line_items' in data
+
+
+def project_wc_order(data, topic=''):
+    """
+    Apply an order coming from WooCommerce to the read model. Failures are only logged: the
+    WooCommerce side already succeeded and a rebuild puts the read model back in sync.
+    """
+    if not ORDER_READ_MODEL_ENABLED or not data or 'id' not in data:
+        return
+    try:
+        if topic == 'order.deleted' or data.get('status') == 'trash':
+            read_model_delete_order(int(data['id']))
+        else:
+            read_model_upsert_orders([order_from_wc_payload(data)])
+    except (sqlite3.Error, ValueError, KeyError) as e:
+        app.logger.error(f"Failed to update the order read model for order {data.get('id')}: {e}")
+
+
+@app.cli.command('rebuild-order-read-model')
+def rebuild_order_read_model():
+    """Fill the order read model from the WordPress tables."""
+    started = time.time()
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            orders, products_by_order = query_wordpress_orders(cursor, (), None, 'ASC')
+
+    written = read_model_upsert_orders([(order, products_by_order.get(order['order_id'], [])) for order in orders],
+                                       projected_at=started)
+
+    # Whatever wasn't rewritten by the rebuild or by a webhook since it started is gone from WordPress
+    with local_transaction() as connection:
+        connection.execute("DELETE FROM order_items WHERE order_id IN "
+                           "(SELECT order_id FROM orders WHERE projected_at < ?)", (started,))
+        removed = connection.execute("DELETE FROM orders WHERE projected_at < ?", (started,)).rowcount
+        connection.execute("INSERT OR REPLACE INTO local_meta (key, value) VALUES ('orders_rebuilt_at', ?)",
+                           (str(started),))
+
+    print(f"####### Order read model rebuilt: {written} orders written, {removed} removed "
+          f"in {time.time() - started:.1f}s")
+
+
+# ===================== Order listing cache =====================
+
+ORDER_CACHE_TIMEOUT = int(os.environ.get('ORDER_CACHE_TIMEOUT', 300))
+# Seconds a loaded listing is handed straight to the next identical requests of this process, 0 to only
+# share the loads running at the same time
+ORDER_SINGLE_FLIGHT_WINDOW = float(os.environ.get('ORDER_SINGLE_FLIGHT_WINDOW', 1.0))
+ALL_STORES = '*'
+
+# Statuses an order can be in before each transition done through this API. When the read model
+# doesn't know the previous status of an order, these are the listings evicted on top of the new status.
+STATUS_TRANSITION_SOURCES = {
+    'wc-preparing': ('wc-processing',),
+    'wc-ready': ('wc-processing', 'wc-preparing'),
+    'wc-completed': ('wc-processing', 'wc-preparing', 'wc-ready'),
+    'wc-refunded': ('wc-processing', 'wc-preparing', 'wc-ready', 'wc-completed'),
+}
+
+# Hits, misses and evictions per key family (the statuses of the listing)
+order_cache_stats = {}
+_order_cache_stats_lock = threading.Lock()
+
+
+def count_order_cache(family, counter):
+    with _order_cache_stats_lock:
+        stats = order_cache_stats.setdefault(family, {'hits': 0, 'misses': 0, 'evictions': 0})
+        stats[counter] += 1
+
+
+class SingleFlight:
+    """
+    Concurrent calls for the same key share a single call of the loader: the first one runs it, the
+    others wait for its result (or its exception). A finished result keeps being returned for `window`
+    seconds. Keys must change when the data does, like the listing keys with their generation tokens.
+    """
+
+    class Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.finished_at = None
+
+    def __init__(self, window):
+        self.window = window
+        self._flights = {}  # key -> Flight
+        self._lock = threading.Lock()
+        self.loaded = 0  # calls that ran the loader
+        self.collapsed = 0  # calls that waited for a running load
+        self.reused = 0  # calls answered by a load finished less than `window` ago
+
+    def _expired(self, flight, now):
+        return flight.finished_at is not None and now - flight.finished_at >= self.window
+
+    def do(self, key, loader):
+        with self._lock:
+            now = time.monotonic()
+            flight = self._flights.get(key)
+            if flight is None or self._expired(flight, now):
+                # Old keys are never asked again once their tokens changed, drop them on the way
+                for old_key in [k for k, f in self._flights.items() if self._expired(f, now)]:
+                    del self._flights[old_key]
+                flight = self._flights[key] = SingleFlight.Flight()
+                self.loaded += 1
+                leader = True
+            else:
+                if flight.finished_at is None:
+                    self.collapsed += 1
+                else:
+                    self.reused += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                flight.finished_at = time.monotonic()
+                if (flight.error is not None or self.window <= 0) and self._flights.get(key) is flight:
+                    del self._flights[key]  # failures are retried by the next call
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': sum(1 for f in self._flights.values() if f.finished_at is None),
+                    'loaded': self.loaded, 'collapsed': self.collapsed, 'reused': self.reused}
+
+
+order_flights = SingleFlight(ORDER_SINGLE_FLIGHT_WINDOW)
+
+
+def order_cache_generations(keys):
+    # Every (store, status) has a token that changes whenever its orders change. The tokens are part
+    # of the listing keys, so changing one makes every listing depending on it unreachable.
+    tokens = cache.get_many(*keys)
+    if None in tokens:
+        for key, token in zip(keys, tokens):
+            if token is None:
+                cache.add(key, uuid.uuid4().hex, timeout=0)
+        tokens = cache.get_many(*keys)
+    return tokens
+
+
+def order_listing_key(statuses, store_name, sort):
+    store = store_name or ALL_STORES
+    generation_keys = [f'orders_gen:{store}:flush'] + [f'orders_gen:{store}:{status}'
+                                                       for status in statuses or ('any',)]
+    tokens = order_cache_generations(generation_keys)
+    return f"orders:{store}:{','.join(statuses) or 'any'}:{sort}:{'.'.join(str(token) for token in tokens)}"
+
+
+def get_cached_orders(status, store_name=None, sort='ASC', window=None):
+    statuses = normalize_statuses(status)
+    family = ','.join(statuses) or 'any'
+    # The key is computed before loading, so a result racing with an invalidation lands on a dead key
+    key = order_listing_key(statuses, store_name, sort)
+    if window:
+        # Pages share the tokens of their listing, so they are evicted together with it
+        key += ':' + hashlib.sha1(repr(sorted(window.items())).encode()).hexdigest()[:16]
+
+    def load():
+        orders = cache.get(key)
+        if orders is not None:
+            count_order_cache(family, 'hits')
+            return orders
+
+        count_order_cache(family, 'misses')
+        orders = get_orders_by_status(statuses, store_name, sort, window)
+        cache.set(key, orders, timeout=ORDER_CACHE_TIMEOUT)
+        return orders
+
+    # All the tablets of a store poll the same listing right after each event, only one of them loads it
+    return order_flights.do(key, load)
+
+
+def invalidate_order_listings(store_name, statuses):
+    """
+    Evict the cached listings of a store that contain any of the given statuses, plus the listings
+    of all the stores. statuses=None evicts every listing of the store.
+    """
+    for store in ([store_name, ALL_STORES] if store_name else [ALL_STORES]):
+        if statuses is None:
+            keys = [f'orders_gen:{store}:flush']
+        else:
+            keys = [f'orders_gen:{store}:{status}' for status in statuses] + [f'orders_gen:{store}:any']
+        cache.set_many({key: uuid.uuid4().hex for key in keys}, timeout=0)
+
+    for status in statuses or ('all',):
+        count_order_cache(status, 'evictions')
+
+
+def sync_order_change(previous, data, topic=''):
+    """
+    Bookkeeping once WooCommerce has a new version of an order: update the read model and evict
+    the cached listings of the order's store for its previous and new status.
+    `previous` is the (store_name, status) from read_model_order_status before the change.
+    Returns the order in the simplified shape, or None when it was deleted.
+    """
+    project_wc_order(data, topic)
+
+    previous_store, previous_status = previous or (None, None)
+    if topic == 'order.deleted' or data.get('status') == 'trash':
+        store_name = previous_store
+        statuses = (previous_status,) if previous_status else None
+        simplified = None
+    else:
+        order, products = order_from_wc_payload(data)
+        store_name = order['store_name'] or previous_store
+        sources = (previous_status,) if previous_status else STATUS_TRANSITION_SOURCES.get(order['status'])
+        statuses = tuple(sources) + (order['status'],) if sources else None
+        simplified = simplify_order_structure(order, products)
+
+    invalidate_order_listings(store_name, statuses)
+    if previous_store and previous_store != store_name:
+        invalidate_order_listings(previous_store, (previous_status,))
+    return simplified
+
+
+# ===================== Order events =====================
+
+# Every change of an order is pushed to the clients with the whole simplified order and a sequence
+# number, so the tablets update their lists in place instead of refetching them. The events are kept
+# for a while so a client coming back can ask for what it missed (/api/orders/deltas?since=<seq>).
+ORDER_EVENTS_RETENTION = int(os.environ.get('ORDER_EVENTS_RETENTION', 24 * 3600))  # seconds
+ORDER_EVENTS_PAGE_SIZE = 500
+
+# Each client joins the room of its store and only gets the events of that store's orders. Clients
+# without a store (managers) join the room of all the stores. Clients use either namespace.
+SOCKETIO_NAMESPACES = ('/', '/ws')
+ALL_STORES_ROOM = 'store:*'
+
+
+def store_room(store_name):
+    return f'store:{store_name}' if store_name else ALL_STORES_ROOM
+
+
+def emit_to_stores(event, data, store_names):
+    # Events of orders without a known store go to every client, as before
+    store_names = {store for store in store_names if store}
+    for namespace in SOCKETIO_NAMESPACES:
+        if store_names:
+            socketio.emit(event, data, to=[store_room(store) for store in store_names] + [ALL_STORES_ROOM],
+                          namespace=namespace)
+        else:
+            socketio.emit(event, data, namespace=namespace)
+
+
+def order_to_json(order):
+    # Same encoding as the REST listings (dates included), so both can be merged client side
+    return json.loads(app.json.dumps(order)) if order is not None else None
+
+
+def record_order_delta(event, order_id, order, store_name=None):
+    """
+    Store a change of an order and return the event sent to the clients:
+    {'seq', 'event', 'order_id', 'order', 'removed'}. order=None means the order is gone, in which
+    case store_name tells which store it belonged to.
+    """
+    payload = order_to_json(order)
+    store_name = order['SHOP'] if order is not None and order['SHOP'] else store_name
+    now = time.time()
+    with local_transaction() as connection:
+        seq = connection.execute("INSERT INTO order_events (order_id, store_name, event, payload, created_at) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (order_id, store_name, event, json.dumps(payload), now)).lastrowid
+        if seq % ORDER_EVENTS_PAGE_SIZE == 0:
+            connection.execute("DELETE FROM order_events WHERE created_at < ?", (now - ORDER_EVENTS_RETENTION,))
+    return {'seq': seq, 'event': event, 'order_id': order_id, 'order': payload, 'removed': order is None}
+
+
+def publish_order_delta(event, order_id, order, previous_store=None):
+    # previous_store: the store the order belonged to before the change, which gets the event as well
+    try:
+        record = record_order_delta(event, order_id, order, previous_store)
+    except sqlite3.Error as e:
+        # The change itself went through, the clients just won't be able to replay this event
+        app.logger.error(f"Failed to record {event} for order {order_id}: {e}")
+        record = {'seq': None, 'event': event, 'order_id': order_id, 'order': order_to_json(order),
+                  'removed': order is None}
+    emit_to_stores(event, record, {order['SHOP'] if order is not None else None, previous_store})
+    return record
+
+
+def get_order_deltas(since, limit=ORDER_EVENTS_PAGE_SIZE, store_name=None):
+    """
+    Events after `since`, oldest first, only those of one store if store_name is given. 'reset' is True
+    when some of the events the client missed were already purged, in which case it has to reload
+    its listings instead of replaying.
+    """
+    connection = local_db()
+    latest_seq, oldest_seq = connection.execute("SELECT max(seq), min(seq) FROM order_events").fetchone()
+    query = "SELECT * FROM order_events WHERE seq > ?"
+    params = [since]
+    if store_name:
+        query += " AND (store_name = ? OR store_name IS NULL)"
+        params.append(store_name)
+    rows = connection.execute(query + " ORDER BY seq LIMIT ?", params + [limit]).fetchall()
+    deltas = [{'seq': row['seq'], 'event': row['event'], 'order_id': row['order_id'],
+               'order': json.loads(row['payload']), 'removed': row['payload'] == 'null'} for row in rows]
+    return {
+        'latest_seq': latest_seq or 0,
+        'deltas': deltas,
+        'has_more': len(deltas) == limit,
+        'reset': oldest_seq is not None and since + 1 < oldest_seq,
+    }
+
+
+@app.route('/api/orders/deltas', methods=['GET'])
+def list_order_deltas():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', ORDER_EVENTS_PAGE_SIZE)), ORDER_EVENTS_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'since and limit must be integers'}), 400
+    return jsonify(get_order_deltas(since, limit, request.args.get('store') or caller_shop()))
+
+
+# ===================== Order changes =====================
+
+# Polling alternative to the Socket.IO events for clients that can't keep a websocket open:
+# /api/orders/<store_name>/changes?since=<token> answers the orders changed since the previous call,
+# the ids of those that left the listing, and the token for the next call. The changes are found
+# through the modification date of the orders (post_modified_gmt / date_updated_gmt), which WooCommerce
+# bumps on every update, status changes included. Deleted orders have no row left to be found that way,
+# their ids come from the removals recorded in order_events, so a token can't be older than those.
+ORDER_CHANGES_PAGE_SIZE = 500
+# WordPress dates have a one second resolution and a save may commit a little after its date, so the
+# changes of the last ORDER_CHANGES_LAG seconds are only handed out by a later call
+ORDER_CHANGES_LAG = int(os.environ.get('ORDER_CHANGES_LAG', 2))
+
+
+class InvalidChangesToken(ValueError):
+    pass
+
+
+def encode_changes_token(modified, order_id):
+    return base64.urlsafe_b64encode(f"{modified}|{order_id}".encode()).decode().rstrip('=')
+
+
+def decode_changes_token(token):
+    # The (modification date, order id) of the last change handed out
+    try:
+        modified, order_id = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode().split('|')
+        datetime.strptime(modified, '%Y-%m-%d %H:%M:%S')
+        return modified, int(order_id)
+    except ValueError as e:  # binascii.Error and UnicodeDecodeError are ValueErrors too
+        raise InvalidChangesToken(f'Invalid changes token {token!r}') from e
+
+
+def gmt_timestamp(date):
+    return datetime.strptime(date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+def removed_order_ids(store_name, since, until):
+    # Ids of the orders deleted or trashed between two GMT dates (since included), from order_events
+    rows = local_db().execute("SELECT DISTINCT order_id FROM order_events WHERE payload = 'null' "
+                              "AND created_at >= ? AND created_at < ? AND (? IS NULL OR store_name = ? "
+                              "OR store_name IS NULL) ORDER BY order_id",
+                              (gmt_timestamp(since), gmt_timestamp(until), store_name, store_name)).fetchall()
+    return [row['order_id'] for row in rows]
+
+
+def get_order_changes(statuses, store_name, token=None):
+    """
+    Orders of the listing (statuses, store_name) changed since `token`, in the simplified shape, and
+    the ids of the orders that are no longer part of it (other status, trashed or deleted).
+    Without a token, or with one older than the recorded removals, the whole listing is returned with
+    reset=True, to replace what the client has.
+    An order may come more than once, the clients just apply its latest version.
+    """
+    horizon = (datetime.utcnow() - timedelta(seconds=ORDER_CHANGES_LAG)).strftime('%Y-%m-%d %H:%M:%S')
+    after = decode_changes_token(token) if token is not None else None
+    if after is None or gmt_timestamp(after[0]) < time.time() - ORDER_EVENTS_RETENTION:
+        # The token is taken before the listing is read, changes made meanwhile come again in the next call
+        return {'token': encode_changes_token(horizon, 0), 'orders': get_cached_orders(statuses, store_name),
+                'removed': [], 'has_more': False, 'reset': True}
+
+    # Removed up to the horizon; when the rows below stop earlier (has_more) the next call repeats some
+    removed = removed_order_ids(store_name, after[0], horizon)
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            query, params = order_storage(cursor).changed_orders_query(store_name, after, horizon,
+                                                                       ORDER_CHANGES_PAGE_SIZE + 1)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+
+    has_more = len(rows) > ORDER_CHANGES_PAGE_SIZE
+    rows = rows[:ORDER_CHANGES_PAGE_SIZE]
+    if not rows:
+        # Nothing changed up to the horizon, the next call starts there
+        return {'token': encode_changes_token(horizon, 0), 'orders': [], 'removed': removed, 'has_more': False,
+                'reset': False}
+
+    order_ids = [row['order_id'] for row in rows]
+    orders = {order['ORDER_ID']: order
+              for order in fetch_orders_from_wordpress((), store_name, order_ids=order_ids)}
+    changed = []
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        if order is None or order['STATUS'] == 'trash' or (statuses and order['STATUS'] not in statuses):
+            if order_id not in removed:
+                removed.append(order_id)
+        else:
+            changed.append(order)
+    return {'token': encode_changes_token(str(rows[-1]['modified']), order_ids[-1]), 'orders': changed,
+            'removed': removed, 'has_more': has_more, 'reset': False}
+
+
+@app.route('/api/orders/changes', methods=['GET'])
+@app.route('/api/orders/<store_name>/changes', methods=['GET'])
+def list_order_changes(store_name=None):
+    # ?status= like /api/orders, the open statuses by default. Poll with the token of the previous answer.
+    statuses = normalize_statuses(request.args.get('status') or OPEN_ORDER_STATUSES)
+    store_name = store_name or caller_shop()
+    token = request.args.get('since') or None
+    try:
+        # The tablets of a store poll with the same token at the same time, they share the query
+        key = f"changes:{store_name or ALL_STORES}:{','.join(statuses)}:{token}:{int(time.time())}"
+        return jsonify(order_flights.do(key, lambda: get_order_changes(statuses, store_name, token)))
+    except InvalidChangesToken as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# ===================== Status outbox =====================
+
+# Optimistic mode: the status routes record the transition locally, notify the clients and answer at
+# once, and the new status is pushed to WooCommerce from the outbox by a background worker.
+OPTIMISTIC_STATUS_UPDATES = os.environ.get('OPTIMISTIC_STATUS_UPDATES', '0') == '1'
+STATUS_OUTBOX_POLL_INTERVAL = float(os.environ.get('STATUS_OUTBOX_POLL_INTERVAL', 5))  # seconds
+# Seconds a worker owns a row while pushing it. A push is a PUT and, when refused, a GET of the order,
+# each of which can be retried up to WC_RETRIES times: the lease outlasts both so no other worker
+# takes the row while it is still being pushed.
+STATUS_OUTBOX_LEASE = 2 * wc_client.worst_case_seconds() + 30
+STATUS_OUTBOX_MAX_BACKOFF = 300  # seconds
+
+_status_outbox_wakeup = threading.Event()
+
+
+def queue_status_update(order_id, status):
+    """
+    Record a status transition in the read model and in the outbox, and evict the affected listings.
+    The outbox has one row per order, so repeated transitions of an order collapse into the last one.
+    `status` is the WooCommerce REST status ('preparing', 'ready', ...). Returns the order as it will
+    be once pushed, in the simplified shape, or None when neither the read model nor WordPress has it.
+    """
+    now = time.time()
+    new_status = f'wc-{status}'
+    previous = read_model_order_status(order_id)
+
+    with local_transaction() as connection:
+        connection.execute("UPDATE orders SET status = ?, projected_at = ? WHERE order_id = ?",
+                           (new_status, now, order_id))
+        connection.execute("""
+            INSERT INTO status_outbox (order_id, status, attempts, next_attempt_at, queued_at)
+            VALUES (?, ?, 0, ?, ?)
+            ON CONFLICT (order_id) DO UPDATE SET status = excluded.status, attempts = 0, last_error = NULL,
+                next_attempt_at = excluded.next_attempt_at, queued_at = excluded.queued_at
+        """, (order_id, status, now, now))
+
+    store_name, previous_status = previous or (None, None)
+    sources = (previous_status,) if previous_status else STATUS_TRANSITION_SOURCES.get(new_status)
+    invalidate_order_listings(store_name, tuple(sources) + (new_status,) if sources else None)
+    _status_outbox_wakeup.set()
+
+    order = load_order(order_id)
+    if order is None and read_model_ready():
+        # Created after the last sync of the read model (its webhook is still on the way)
+        try:
+            orders = fetch_orders_from_wordpress((), order_ids=[order_id])
+            order = orders[0] if orders else None
+        except (pymysql.err.MySQLError, PoolTimeoutError) as e:
+            app.logger.warning(f"Order {order_id} not loaded after its status change: {e}")
+    if order is not None:
+        order['STATUS'] = new_status  # when read from WordPress it doesn't have the transition yet
+    return order
+
+
+def publish_status_change(event, order_id, order):
+    # An order nobody could load is unknown, not removed: no event the clients would take for a removal
+    if order is None:
+        app.logger.warning(f"{event} for order {order_id}, which isn't known, not sent to the clients")
+        return None
+    return publish_order_delta(event, order_id, order)
+
+
+def claim_status_outbox(limit=20):
+    # Rows are leased so several workers (or processes) never push the same transition twice
+    now = time.time()
+    claimed = []
+    with local_transaction() as connection:
+        rows = connection.execute("SELECT * FROM status_outbox WHERE next_attempt_at <= ? "
+                                  "ORDER BY queued_at LIMIT ?", (now, limit)).fetchall()
+        for row in rows:
+            connection.execute("UPDATE status_outbox SET next_attempt_at = ? WHERE order_id = ?",
+                               (now + STATUS_OUTBOX_LEASE, row['order_id']))
+            claimed.append(dict(row))
+    return claimed
+
+
+def push_status_update(row):
+    order_id, status = row['order_id'], row['status']
+    try:
+        response = wc_client.put(f"orders/{order_id}", json={'status': status})
+    except WooCommerceUnavailableError as e:
+        response, error = None, str(e)
+    else:
+        error = f"{response.status_code} {response.text[:200]}"
+
+    if response is not None and response.ok:
+        with local_transaction() as connection:
+            # A newer transition queued meanwhile must not be overwritten by this one
+            delivered = connection.execute("DELETE FROM status_outbox WHERE order_id = ? AND queued_at = ?",
+                                           (order_id, row['queued_at'])).rowcount
+        if delivered:
+            sync_order_change(read_model_order_status(order_id), response.json())
+        return
+
+    if response is not None and 400 <= response.status_code < 500 and response.status_code != 429:
+        # WooCommerce refused the transition, retrying won't help: drop it and restore the real order
+        app.logger.error(f"WooCommerce refused status {status} for order {order_id}: {error}")
+        with local_transaction() as connection:
+            dropped = connection.execute("DELETE FROM status_outbox WHERE order_id = ? AND queued_at = ?",
+                                         (order_id, row['queued_at'])).rowcount
+        if not dropped:
+            return  # a newer transition was queued meanwhile, the clients show that one and it gets pushed next
+        order = None
+        try:
+            current = wc_client.get(f"orders/{order_id}")
+            if current.ok:
+                order = sync_order_change(read_model_order_status(order_id), current.json())
+        except WooCommerceUnavailableError:
+            pass  # the next webhook or rebuild fixes the read model
+        # Carries the restored order so the clients can undo the optimistic transition
+        publish_status_change('order_status_failed', order_id, order or load_order(order_id))
+        return
+
+    attempts = row['attempts'] + 1
+    delay = min(STATUS_OUTBOX_MAX_BACKOFF, 2 ** attempts)
+    app.logger.warning(f"Status {status} for order {order_id} not pushed (attempt {attempts}): {error}")
+    with local_transaction() as connection:
+        connection.execute("UPDATE status_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? "
+                           "WHERE order_id = ? AND queued_at = ?",
+                           (attempts, time.time() + delay, error, order_id, row['queued_at']))
+
+
+def status_outbox_worker():
+    # Rows left by a previous run are picked up on the first pass
+    while True:
+        _status_outbox_wakeup.clear()
+        try:
+            rows = claim_status_outbox()
+            for row in rows:
+                push_status_update(row)
+        except Exception as e:
+            app.logger.error(f"Status outbox worker failed: {e}")
+            rows = []
+        if not rows:
+            _status_outbox_wakeup.wait(STATUS_OUTBOX_POLL_INTERVAL)
+
+
+def status_outbox_stats():
+    row = local_db().execute("SELECT count(*) AS pending, coalesce(max(attempts), 0) AS max_attempts, "
+                             "min(queued_at) AS oldest FROM status_outbox").fetchone()
+    return {'pending': row['pending'], 'max_attempts': row['max_attempts'],
+            'oldest_age_seconds': time.time() - row['oldest'] if row['oldest'] else 0.0}
+
+
+# ===================== Webhook inbox =====================
+
+# WooCommerce fires several webhooks per order during checkout (created, updated, paid...). handle_webhook
+# only stores them here, one row per order/product/customer, so a burst collapses into its latest state,
+# and webhook_worker applies that state once the row is WEBHOOK_COALESCE_WINDOW old.
+WC_WEBHOOK_SECRET = os.environ.get('WC_WEBHOOK_SECRET')  # the webhook's secret in WooCommerce, unsigned if unset
+WEBHOOK_COALESCE_WINDOW = float(os.environ.get('WEBHOOK_COALESCE_WINDOW', 0.5))  # seconds
+WEBHOOK_DEDUPE_TTL = int(os.environ.get('WEBHOOK_DEDUPE_TTL', 86400))  # seconds a delivery id is remembered
+WEBHOOK_POLL_INTERVAL = 5  # seconds, for rows queued by the other workers
+WEBHOOK_BATCH_SIZE = 100
+# Seconds a worker owns the rows it claimed. Processing only touches the read model, the cache and
+# Socket.IO, the lease covers a whole batch of them with a large margin.
+WEBHOOK_LEASE = int(os.environ.get('WEBHOOK_LEASE', 300))
+WEBHOOK_MAX_BACKOFF = 300  # seconds
+WEBHOOK_MAX_ATTEMPTS = 10  # then dropped, a rebuild of the read model catches up with it
+
+_webhook_wakeup = threading.Event()
+webhook_stats = {'received': 0, 'duplicates': 0, 'coalesced': 0, 'processed': 0, 'failed': 0}
+_webhook_stats_lock = threading.Lock()
+
+
+def count_webhook(outcome, amount=1):
+    with _webhook_stats_lock:
+        webhook_stats[outcome] += amount
+
+
+def valid_webhook_signature(body, signature):
+    # X-WC-Webhook-Signature is the base64 HMAC-SHA256 of the raw body keyed with the webhook's secret
+    expected = base64.b64encode(hmac.new(WC_WEBHOOK_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return hmac.compare_digest(expected, signature)
+
+
+def webhook_key(topic, data):
+    # Webhooks about the same object share a row, anything else gets its own
+    if is_order_webhook(topic, data):
+        return f"order:{data['id']}"
+    resource = topic.split('.')[0]
+    if resource in ('product', 'customer') and data.get('id') is not None:
+        return f"{resource}:{data['id']}"
+    return f"{topic}:{uuid.uuid4().hex}"
+
+
+def queue_webhook(topic, data, payload):
+    now = time.time()
+    key = webhook_key(topic, data)
+    with local_transaction() as connection:
+        queued = connection.execute("SELECT 1 FROM webhook_inbox WHERE key = ?", (key,)).fetchone()
+        # A newer version replaces the queued one, a late redelivery of an older one doesn't, and once
+        # deleted the object stays deleted
+        connection.execute("""
+            INSERT INTO webhook_inbox (key, topic, payload, modified, received_at, due_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET topic = excluded.topic, payload = excluded.payload,
+                modified = excluded.modified, received_at = excluded.received_at
+            WHERE webhook_inbox.topic NOT LIKE '%.deleted'
+              AND (excluded.topic LIKE '%.deleted' OR excluded.modified IS NULL OR webhook_inbox.modified IS NULL
+                   OR excluded.modified >= webhook_inbox.modified)
+        """, (key, topic, payload, data.get('date_modified_gmt'), now, now + WEBHOOK_COALESCE_WINDOW))
+    count_webhook('received')
+    if queued:
+        count_webhook('coalesced')
+    _webhook_wakeup.set()
+
+
+def claim_webhooks():
+    # Due rows are leased in the same transaction, so each one is processed by a single worker, and stay in
+    # the inbox until processed: a crash leaves them to be claimed again once the lease is over.
+    # Returns them with the due time of the next row still waiting, if any.
+    now = time.time()
+    with local_transaction() as connection:
+        rows = connection.execute("SELECT key, topic, payload, received_at, attempts FROM webhook_inbox "
+                                  "WHERE due_at <= ? ORDER BY due_at LIMIT ?", (now, WEBHOOK_BATCH_SIZE)).fetchall()
+        connection.executemany("UPDATE webhook_inbox SET due_at = ? WHERE key = ?",
+                               [(now + WEBHOOK_LEASE, row['key']) for row in rows])
+        next_due = connection.execute("SELECT min(due_at) FROM webhook_inbox").fetchone()[0]
+    return rows, next_due
+
+
+def finish_webhook(row, error=None):
+    # Deletes the row once processed, or schedules a retry. A newer version queued meanwhile (same key, later
+    # received_at) stays and is due at once, it was waiting for the lease of this one.
+    with local_transaction() as connection:
+        if error is None or row['attempts'] + 1 >= WEBHOOK_MAX_ATTEMPTS:
+            done = connection.execute("DELETE FROM webhook_inbox WHERE key = ? AND received_at = ?",
+                                      (row['key'], row['received_at'])).rowcount
+        else:
+            attempts = row['attempts'] + 1
+            done = connection.execute("UPDATE webhook_inbox SET attempts = ?, due_at = ?, last_error = ? "
+                                      "WHERE key = ? AND received_at = ?",
+                                      (attempts, time.time() + min(WEBHOOK_MAX_BACKOFF, 2 ** attempts), error,
+                                       row['key'], row['received_at'])).rowcount
+        if not done:
+            connection.execute("UPDATE webhook_inbox SET attempts = 0, due_at = ? WHERE key = ?",
+                               (time.time(), row['key']))
+
+
+def webhook_worker():
+    # Rows left by a previous run are picked up on the first pass
+    while True:
+        _webhook_wakeup.clear()
+        try:
+            rows, next_due = claim_webhooks()
+        except Exception as e:
+            app.logger.error(f"Webhook worker failed: {e}")
+            rows, next_due = [], None
+
+        for row in rows:
+            try:
+                process_webhook(row['topic'], json.loads(row['payload']))
+                count_webhook('processed')
+                error = None
+            except Exception as e:
+                count_webhook('failed')
+                error = str(e)
+                if row['attempts'] + 1 >= WEBHOOK_MAX_ATTEMPTS:
+                    # Already acknowledged, a rebuild of the read model catches up with what was missed
+                    app.logger.error(f"Webhook {row['topic']} ({row['key']}) dropped after {WEBHOOK_MAX_ATTEMPTS} "
+                                     f"attempts: {e}")
+                else:
+                    app.logger.warning(f"Failed to process webhook {row['topic']} ({row['key']}), "
+                                       f"attempt {row['attempts'] + 1}: {e}")
+            try:
+                finish_webhook(row, error)
+            except Exception as e:
+                # Left leased, claimed and processed again once the lease is over
+                app.logger.error(f"Failed to finish webhook {row['topic']} ({row['key']}): {e}")
+
+        if not rows:
+            wait = WEBHOOK_POLL_INTERVAL if next_due is None else next_due - time.time()
+            _webhook_wakeup.wait(min(max(wait, 0.01), WEBHOOK_POLL_INTERVAL))
+
+
+def webhook_inbox_stats():
+    pending = local_db().execute("SELECT count(*) FROM webhook_inbox").fetchone()[0]
+    with _webhook_stats_lock:
+        return {'pending': pending, **webhook_stats}
+
+
+# ===================== Background workers =====================
+
+_background_workers_started = False
+_background_workers_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_workers():
+    # Started with the first request (or by __main__) instead of at import time, so the CLI commands
+    # don't spawn them
+    global _background_workers_started
+    if _background_workers_started:
+        return
+    with _background_workers_lock:
+        if _background_workers_started:
+            return
+        _background_workers_started = True
+    socketio.start_background_task(status_outbox_worker)
+    socketio.start_background_task(webhook_worker)
+    socketio.start_background_task(refund_recovery_worker)
+
+
+def list_orders_response(store_name, status, sort_order=None):
+    # Shared by all the /api/orders routes
+    sort_order = sort_order or get_sort_asc_desc(request)
+    if isinstance(sort_order, tuple):
+        return sort_order  # invalid sort parameter, already an error response
+    window = parse_order_window(request.args)
+    if isinstance(window, tuple):
+        return window
+
+    # Without a store in the URL, the caller's own shop (see current_user) if it has one
+    orders = get_cached_orders(status, store_name or caller_shop(), sort_order, window)
+    response = jsonify(orders)
+    if window and window['limit'] and len(orders) == window['limit']:
+        # The body stays a plain list for the existing clients, the cursor of the next page goes in a header
+        response.headers['X-Next-After'] = str(orders[-1]['ORDER_ID'])
+    return response
 
 
 @app.route('/api/orders', methods=['GET'])
 @app.route('/api/orders/<store_name>', methods=['GET'])
 def get_all_store_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name> on {datetime.now()}")
-    sort_order = get_sort_asc_desc(request)
-    all_orders = get_orders_by_status(None, store_name, sort_order)
-    return jsonify(all_orders)
+    # ?status=processing,preparing,ready (or ?status=open) filters the statuses, all of them by default
+    return list_orders_response(store_name, request.args.get('status'))
 
 
 @app.route('/api/orders/open', methods=['GET'])
 @app.route('/api/orders/<store_name>/open', methods=['GET'])
 def get_store_open_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name>/open on {datetime.now()}")
-    sort_order = get_sort_asc_desc(request)
-    processing_orders = get_orders_by_status('wc-processing', store_name, sort_order)
-    preparing_orders = get_orders_by_status('wc-preparing', store_name, sort_order)
-    ready_orders = get_orders_by_status('wc-ready', store_name, sort_order)
-    open_orders = processing_orders + preparing_orders + ready_orders
-    return jsonify(open_orders)
+    return list_orders_response(store_name, OPEN_ORDER_STATUSES)
 
 
 @app.route('/api/orders/processing', methods=['GET'])
 @app.route('/api/orders/<store_name>/processing', methods=['GET'])
 def get_store_processing_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name>/processing on {datetime.now()}")
-    sort_order = get_sort_asc_desc(request)
-    processing_orders = get_orders_by_status('wc-processing', store_name, sort_order)
-    return jsonify(processing_orders)
+    return list_orders_response(store_name, 'wc-processing')
 
 
 @app.route('/api/orders/preparing', methods=['GET'])
 @app.route('/api/orders/<store_name>/preparing', methods=['GET'])
 def get_store_preparing_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name>/preparing on {datetime.now()}")
-    sort_order = get_sort_asc_desc(request)
-    preparing_orders = get_orders_by_status('wc-preparing', store_name, sort_order)
-    return jsonify(preparing_orders)
+    return list_orders_response(store_name, 'wc-preparing')
 
 
 @app.route('/api/orders/ready', methods=['GET'])
 @app.route('/api/orders/<store_name>/ready', methods=['GET'])
 def get_store_ready_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name>/ready on {datetime.now()}")
-    sort_order = get_sort_asc_desc(request)
-    ready_orders = get_orders_by_status('wc-ready', store_name, sort_order)
-    return jsonify(ready_orders)
+    return list_orders_response(store_name, 'wc-ready')
 
 
 @app.route('/api/orders/completed', methods=['GET'])
 @app.route('/api/orders/<store_name>/completed', methods=['GET'])
 def get_store_completed_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name>/completed on {datetime.now()}")
-    sort_order = 'DESC'  # get_sort_asc_desc(request)
-    completed_orders = get_orders_by_status('wc-completed', store_name, sort_order)
-    return jsonify(completed_orders)
+    return list_orders_response(store_name, 'wc-completed', 'DESC')  # get_sort_asc_desc(request)
 
 
 @app.route('/api/orders/refunded', methods=['GET'])
 @app.route('/api/orders/<store_name>/refunded', methods=['GET'])
 def get_store_refunded_orders(store_name=None):
-    print(f"####### ENDPOINT CALLED: /api/orders/<store_name>/refunded on {datetime.now()}")
-    sort_order = get_sort_asc_desc(request)
-    refunded_orders = get_orders_by_status('wc-refunded', store_name, sort_order)
-    return jsonify(refunded_orders)
+    return list_orders_response(store_name, 'wc-refunded')
 
 
 # Change the order status to "preparing"
 @app.route('/prepare-order/<int:order_id>', methods=['POST'])
 def prepare_order(order_id):
-    print(f"####### ENDPOINT CALLED: /api/prepare-order/<int:order_id> on {datetime.now()}")
     data_payload = {'status': 'preparing'}  # preparing is not a WordPress status, it is a custom status
-    response = requests.put(f"{WC_API_URL}/orders/{order_id}",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                            json=data_payload, verify=False)
 
-    if response.ok:
-        # Your logic for when order status change is successful
-        cache.delete('processing_orders')  # Update cache accordingly
-        socketio.emit('order_preparing', {'order_id': order_id}, broadcast=True)
-        return jsonify({'success': 'Order status updated to preparing'})
+    if OPTIMISTIC_STATUS_UPDATES:
+        order = queue_status_update(order_id, data_payload['status'])
     else:
-        # Your logic for when order status change fails
-        return jsonify({'error': 'Failed to change order status to preparing'}), response.status_code
+        previous = read_model_order_status(order_id)
+        response = wc_client.put(f"orders/{order_id}", json=data_payload)
+        if not response.ok:
+            # Your logic for when order status change fails
+            return jsonify({'error': 'Failed to change order status to preparing'}), response.status_code
+        order = sync_order_change(previous, response.json())  # Update read model and cache accordingly
+
+    publish_status_change('order_preparing', order_id, order)
+    return jsonify({'success': 'Order status updated to preparing'})
 
 
 @app.route('/mark-ready/<int:order_id>', methods=['POST'])
 def mark_order_as_ready(order_id):
-    print(f"####### ENDPOINT CALLED: /api/mark-ready/{order_id} on {datetime.now()}")
-
     data_payload = {'status': 'ready'}  # preparing is not a WordPress status, it is a custom status
-    response = requests.put(f"{WC_API_URL}/orders/{order_id}",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                            json=data_payload,
-                            verify=False)  # TODO Proper SSL verification is recommended in production
 
-    if response.ok:
-        socketio.emit('order_ready', {'order_id': order_id}, broadcast=True)
-        return jsonify({'success': 'Order status updated to ready'}), 200
+    if OPTIMISTIC_STATUS_UPDATES:
+        order = queue_status_update(order_id, data_payload['status'])
     else:
-        app.logger.error(f"Failed to mark order {order_id} as ready: {response.text}")
-        return jsonify(
-            {'error': 'Failed to update order status to ready', 'details': response.text}), response.status_code
+        previous = read_model_order_status(order_id)
+        response = wc_client.put(f"orders/{order_id}", json=data_payload)
+        if not response.ok:
+            app.logger.error(f"Failed to mark order {order_id} as ready: {response.text}")
+            return jsonify(
+                {'error': 'Failed to update order status to ready', 'details': response.text}), response.status_code
+        order = sync_order_change(previous, response.json())
+
+    publish_status_change('order_ready', order_id, order)
+    return jsonify({'success': 'Order status updated to ready'}), 200
 
 
 # Complete the order
@@ -368,33 +2433,116 @@ def complete_order(order_id):
         # Respond to the preflight request with an appropriate CORS header
         return jsonify({'message': 'Success'}), 200
 
-    if request.method == 'POST':
-        print(f"####### ENDPOINT CALLED: /api/complete-order/{order_id} on {datetime.now()}")
-        data_payload = {'status': 'completed'}
-        response = requests.put(f"{WC_API_URL}/orders/{order_id}",
-                                auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                                json=data_payload, verify=False)
-        if response.ok:
-            # Check if specific cache keys exist before deleting using cache.get
-            if cache.get('processing_orders') is not None:
-                cache.delete('processing_orders')
-            if cache.get('completed_orders') is not None:
-                cache.delete('completed_orders')
-
-            # Use socketio.emit to broadcast messages
-            socketio.emit('order_completed', {'order_id': order_id}, broadcast=True)
-            return jsonify({'success': 'Order status updated to completed'})
-        else:
+    data_payload = {'status': 'completed'}
+
+    if OPTIMISTIC_STATUS_UPDATES:
+        order = queue_status_update(order_id, data_payload['status'])
+    else:
+        previous = read_model_order_status(order_id)
+        response = wc_client.put(f"orders/{order_id}", json=data_payload)
+        if not response.ok:
             return jsonify({'error': 'Failed to complete order', 'details': response.text}), response.status_code
+        # Update the read model and evict the cached listings of the order's store
+        order = sync_order_change(previous, response.json())
 
+    # Send the updated order to the clients
+    publish_status_change('order_completed', order_id, order)
+    return jsonify({'success': 'Order status updated to completed'})
 
-# Database configuration - update these values based on your database
-db_config = {
-    'user': 'wordpress',
-    'password': 'admin123',
-    'host': 'localhost',
-    'database': 'wordpress',
-}
+
+# Max number of orders per call to WooCommerce's orders/batch endpoint
+WC_BATCH_SIZE = 100
+
+
+@app.route('/api/orders/batch-status', methods=['POST'])
+def batch_update_order_status():
+    """
+    Change the status of many orders at once, e.g. when closing a shift. Accepts
+    {"orders": [{"id": 1, "status": "ready"}, ...]} or {"order_ids": [1, 2], "status": "completed"}.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        if not isinstance(data, dict) or not isinstance(data.get('orders', data.get('order_ids') or []), list):
+            raise TypeError('the body must be an object with a list of orders or order_ids')
+        if 'orders' in data:
+            updates = data['orders']
+        else:
+            updates = [{'id': order_id, 'status': data.get('status')} for order_id in data.get('order_ids') or []]
+        # WooCommerce wants the status without the wc- prefix
+        updates = [{'id': int(update['id']), 'status': update['status'].removeprefix('wc-')} for update in updates]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify({'error': 'Each order needs an id and a status'}), 400
+    if not updates:
+        return jsonify({'error': 'No orders to update'}), 400
+
+    results, deltas = [], []
+    if OPTIMISTIC_STATUS_UPDATES:
+        # Through the outbox like the single status routes, where each order's last transition wins
+        results = queue_status_batch(updates, deltas)
+    else:
+        for start in range(0, len(updates), WC_BATCH_SIZE):
+            results.extend(push_status_batch(updates[start:start + WC_BATCH_SIZE], deltas))
+
+    # One event per store for the whole batch instead of one per order, each delta keeps its own seq
+    deltas_by_store = {}
+    for delta in deltas:
+        deltas_by_store.setdefault(delta['order'] and delta['order']['SHOP'], []).append(delta)
+    for store_name, store_deltas in deltas_by_store.items():
+        emit_to_stores('orders_status_updated', {'orders': store_deltas}, {store_name})
+
+    updated = sum(1 for result in results if result['success'])
+    return jsonify({'updated': updated, 'failed': len(results) - updated, 'results': results})
+
+
+def queue_status_batch(updates, deltas):
+    # queue_status_update for each order, returns a result per order and adds the order events to deltas
+    results = []
+    for update in updates:
+        order = queue_status_update(update['id'], update['status'])
+        if order is not None:
+            try:
+                deltas.append(record_order_delta('order_delta', update['id'], order))
+            except sqlite3.Error as e:
+                app.logger.error(f"Failed to record the status change of order {update['id']}: {e}")
+        results.append({'order_id': update['id'], 'status': update['status'], 'success': True, 'error': None})
+    return results
+
+
+def supersede_status_outbox(order_ids):
+    # A status written straight to WooCommerce replaces the transitions of those orders still waiting in
+    # the outbox, which would otherwise be pushed after it and move the orders back
+    with local_transaction() as connection:
+        connection.executemany("DELETE FROM status_outbox WHERE order_id = ?", [(order_id,) for order_id in order_ids])
+
+
+def push_status_batch(updates, deltas):
+    # One call to orders/batch, returns a result per order and adds the order events to deltas
+    previous = {update['id']: read_model_order_status(update['id']) for update in updates}
+    supersede_status_outbox([update['id'] for update in updates])
+    try:
+        response = wc_client.post("orders/batch", json={'update': updates})
+        error = None if response.ok else f"{response.status_code} {response.text[:200]}"
+    except WooCommerceUnavailableError as e:
+        response, error = None, str(e)
+
+    if error:
+        app.logger.error(f"Batch status update failed: {error}")
+        return [{'order_id': update['id'], 'status': update['status'], 'success': False, 'error': error}
+                for update in updates]
+
+    results = []
+    for item in response.json().get('update', []):
+        if 'error' in item:
+            results.append({'order_id': item.get('id'), 'status': None, 'success': False,
+                            'error': item['error'].get('message')})
+            continue
+        order = sync_order_change(previous.get(item['id']), item)
+        try:
+            deltas.append(record_order_delta('order_delta', item['id'], order))
+        except sqlite3.Error as e:
+            app.logger.error(f"Failed to record the status change of order {item['id']}: {e}")
+        results.append({'order_id': item['id'], 'status': item['status'], 'success': True, 'error': None})
+    return results
 
 
 def authenticate(inbound_request):
@@ -416,218 +2564,974 @@ def get_order_stripe_charge_id(order_id):
     """
     Retrieve the Stripe charge ID for a given WooCommerce order ID.
     """
-    connection = mysql.connector.connect(**db_config)
-    cursor = connection.cursor(dictionary=True)
-
-    try:
-        # WooCommerce stores order meta in the wp_postmeta table. Adjust meta_key as needed.
-        cursor.execute("""
-            SELECT meta_value AS stripe_charge_id
-            FROM wp_postmeta 
-            WHERE post_id = %s AND meta_key = '_transaction_id'
-        """, (order_id,))
+    with db_connection() as connection, connection.cursor() as cursor:
+        cursor.execute(order_storage(cursor).stripe_charge_query, (order_id,))
         result = cursor.fetchone()
         return result['stripe_charge_id'] if result else None
-    finally:
-        cursor.close()
-        connection.close()
 
 
 def update_order_status(order_id, status):
     data_payload = {'status': 'refunded' if status == 'refunded' else status}
-    response = requests.put(f"{WC_API_URL}/orders/{order_id}",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                            json=data_payload,
-                            verify=False)
+    previous = read_model_order_status(order_id)
+    supersede_status_outbox([order_id])
+    response = wc_client.put(f"orders/{order_id}", json=data_payload)
     if response.ok:
+        sync_order_change(previous, response.json())
         return True
     else:
-        print(f"Failed to update order status in WooCommerce: {response.status_code}, {response.text}")
+        app.logger.error(f"Failed to update order status in WooCommerce: {response.status_code}, {response.text}")
         return False
 
 
-@app.route('/refund-order/<int:order_id>', methods=['POST'])
-def refund_order(order_id):
-    print(f"####### ENDPOINT CALLED: /api/refund-order/<int:order_id> on {datetime.now()}")
-    if not authenticate(request):
-        return jsonify({'error': 'Authentication failed'}), 403
+# ===================== Refunds =====================
+
+# Each refund goes through a row of the refunds table, one per order:
+#   pending         -> Stripe hasn't confirmed the refund yet
+#   stripe_refunded -> the money is back, WooCommerce still shows the old status
+#   completed       -> WooCommerce has the order as refunded
+#   failed          -> Stripe refused it (or there is no charge), a new request starts it over
+# The Stripe call carries the idempotency key of the row, so running a row again after a timeout or a
+# crash never refunds twice. Rows left halfway are picked up again by refund_recovery_worker.
+REFUND_WORKERS = int(os.environ.get('REFUND_WORKERS', 4))  # concurrent refunds of a batch
+REFUND_BATCH_MAX = 500  # orders in one /api/refunds/batch
+STRIPE_TIMEOUT = 80  # seconds, the default of the Stripe client per request
+# Seconds a worker owns a row while running it. A run is at most a list and a create of refunds in Stripe,
+# each retried up to stripe.max_network_retries times, then the PUT of the order status: the lease outlasts
+# all of them so no other worker starts the same refund meanwhile.
+REFUND_LEASE = 2 * (stripe.max_network_retries + 1) * STRIPE_TIMEOUT + wc_client.worst_case_seconds() + 30
+REFUND_MAX_ATTEMPTS = 10  # the recovery leaves the row alone after that, see last_error
+REFUND_RECOVERY_INTERVAL = 60  # seconds
+
+refund_executor = ThreadPoolExecutor(max_workers=REFUND_WORKERS, thread_name_prefix='refund')
+
 
-    stripe_charge_id = get_order_stripe_charge_id(order_id)
-    if not stripe_charge_id:
-        return jsonify({'error': 'Order not found or Stripe charge ID missing'}), 404
+def new_refund_idempotency_key(order_id):
+    return f'refund-order-{order_id}-{uuid.uuid4().hex[:8]}'
 
+
+def start_refund(order_id, batch_id=None):
+    """
+    Create the refund row of an order, or return the existing one. A failed refund is reset to pending
+    with a new idempotency key, Stripe would otherwise answer with the stored failure.
+    """
+    now = time.time()
+    with local_transaction() as connection:
+        connection.execute("""
+            INSERT INTO refunds (order_id, state, idempotency_key, batch_id, attempts, lease_until, created_at,
+                                 updated_at)
+            VALUES (?, 'pending', ?, ?, 0, 0, ?, ?)
+            ON CONFLICT (order_id) DO UPDATE SET state = 'pending', idempotency_key = ?, attempts = 0,
+                batch_id = coalesce(excluded.batch_id, refunds.batch_id), last_error = NULL,
+                updated_at = excluded.updated_at
+            WHERE refunds.state = 'failed'
+        """, (order_id, f'refund-order-{order_id}', batch_id, now, now, new_refund_idempotency_key(order_id)))
+        if batch_id:
+            # An order refunded on its own before shows up in the batch, one of another batch stays there
+            connection.execute("UPDATE refunds SET batch_id = ? WHERE order_id = ? AND batch_id IS NULL",
+                               (batch_id, order_id))
+        return connection.execute("SELECT * FROM refunds WHERE order_id = ?", (order_id,)).fetchone()
+
+
+def claim_refund(order_id):
+    # The row if this worker may run it now, None when it is finished or another worker holds it
+    now = time.time()
+    with local_transaction() as connection:
+        claimed = connection.execute("UPDATE refunds SET lease_until = ?, attempts = attempts + 1 "
+                                     "WHERE order_id = ? AND state IN ('pending', 'stripe_refunded') "
+                                     "AND lease_until <= ?", (now + REFUND_LEASE, order_id, now)).rowcount
+        row = connection.execute("SELECT * FROM refunds WHERE order_id = ?", (order_id,)).fetchone()
+    return row if claimed else None
+
+
+def load_refund(order_id):
+    return local_db().execute("SELECT * FROM refunds WHERE order_id = ?", (order_id,)).fetchone()
+
+
+def save_refund(order_id, state, error=None, **columns):
+    # Store the outcome of a step and give the row up
+    assignments = ''.join(f', {column} = ?' for column in columns)
+    with local_transaction() as connection:
+        connection.execute(f"UPDATE refunds SET state = ?, last_error = ?, lease_until = 0, updated_at = ?"
+                           f"{assignments} WHERE order_id = ?",
+                           (state, error, time.time(), *columns.values(), order_id))
+
+
+def existing_stripe_refund(charge_id):
+    # The refund already made on a charge, None when there is none (or only failed/canceled ones)
+    return next((refund for refund in stripe.Refund.list(charge=charge_id, limit=10).data
+                 if getattr(refund, 'status', None) not in ('failed', 'canceled')), None)
+
+
+def stripe_refund(charge_id, idempotency_key, check_existing=False):
+    # check_existing: the previous attempt may have refunded the charge, take that refund over if so
+    if check_existing:
+        refund = existing_stripe_refund(charge_id)
+        if refund is not None:
+            return refund
     try:
-        refund = stripe.Refund.create(charge=stripe_charge_id)
-    except stripe.error.StripeError as e:
-        return jsonify({'error': str(e)}), 500
+        return stripe.Refund.create(charge=charge_id, idempotency_key=idempotency_key)
+    except stripe.error.InvalidRequestError as e:
+        if e.code != 'charge_already_refunded':
+            raise
+        # Refunded by an earlier key (or from the Stripe dashboard): carry on with that refund
+        refund = existing_stripe_refund(charge_id)
+        if refund is None:
+            raise
+        return refund
+
+
+def process_refund(order_id):
+    """
+    Move a refund as far as it can go and return its row. Safe to call from several workers at
+    once and as often as needed.
+    """
+    row = claim_refund(order_id)
+    if row is None:
+        return load_refund(order_id)
+
+    if row['state'] == 'pending':
+        charge_id = row['charge_id'] or get_order_stripe_charge_id(order_id)
+        if not charge_id:
+            save_refund(order_id, 'failed', 'Order not found or Stripe charge ID missing')
+            return load_refund(order_id)
+        try:
+            # A pending row with an error: the outcome of the last attempt is unknown
+            refund = stripe_refund(charge_id, row['idempotency_key'], check_existing=row['last_error'] is not None)
+        except (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.IdempotencyError) as e:
+            # Stripe may or may not have done it, the same key finds out on the next attempt. An
+            # IdempotencyError (409) is another request with this key still running in Stripe.
+            save_refund(order_id, 'pending', str(e), charge_id=charge_id)
+            return load_refund(order_id)
+        except stripe.error.APIError as e:
+            # Stripe saves a 500 under its idempotency key and would only replay it: the next attempt
+            # looks for a refund this one made anyway, then tries again with a new key
+            save_refund(order_id, 'pending', str(e), charge_id=charge_id,
+                        idempotency_key=new_refund_idempotency_key(order_id))
+            return load_refund(order_id)
+        except stripe.error.StripeError as e:
+            save_refund(order_id, 'failed', str(e), charge_id=charge_id)
+            return load_refund(order_id)
+        save_refund(order_id, 'stripe_refunded', charge_id=charge_id, stripe_refund_id=refund.id)
 
     # Update the order status in WordPress to 'refunded'
-    if update_order_status(order_id, 'refunded'):
-        return jsonify({'success': 'Order refunded successfully', 'refund_id': refund.id})
-    else:
-        return jsonify({'error': 'Failed to update order status in WordPress'}), 500
+    try:
+        updated = update_order_status(order_id, 'refunded')
+        error = None if updated else 'Failed to update order status in WordPress'
+    except WooCommerceUnavailableError as e:
+        updated, error = False, str(e)
+    save_refund(order_id, 'completed' if updated else 'stripe_refunded', error)
+    return load_refund(order_id)
+
+
+def run_refund(order_id):
+    # process_refund for the pool, where nobody is waiting for the exception
+    try:
+        process_refund(order_id)
+    except Exception as e:
+        app.logger.error(f"Refund of order {order_id} failed: {e}")
+
+
+def refund_recovery_worker():
+    # Refunds interrupted by a restart, a Stripe timeout or WooCommerce being down, the first pass at startup
+    while True:
+        try:
+            rows = local_db().execute("SELECT order_id FROM refunds WHERE state IN ('pending', 'stripe_refunded') "
+                                      "AND lease_until <= ? AND attempts < ?",
+                                      (time.time(), REFUND_MAX_ATTEMPTS)).fetchall()
+            for row in rows:
+                refund_executor.submit(run_refund, row['order_id'])
+        except Exception as e:
+            app.logger.error(f"Refund recovery failed: {e}")
+        socketio.sleep(REFUND_RECOVERY_INTERVAL)
+
+
+def refund_to_json(row):
+    return {'order_id': row['order_id'], 'state': row['state'], 'refund_id': row['stripe_refund_id'],
+            'error': row['last_error'], 'attempts': row['attempts']}
+
+
+def refund_stats():
+    rows = local_db().execute("SELECT state, count(*) AS refunds FROM refunds GROUP BY state").fetchall()
+    return {row['state']: row['refunds'] for row in rows}
+
+
+@app.route('/refund-order/<int:order_id>', methods=['POST'])
+def refund_order(order_id):
+    if not authenticate(request):
+        return jsonify({'error': 'Authentication failed'}), 403
+
+    # Retrying the request after a timeout picks the same refund up where it stopped
+    start_refund(order_id)
+    refund = process_refund(order_id)
+    if refund['state'] == 'completed':
+        return jsonify({'success': 'Order refunded successfully', 'refund_id': refund['stripe_refund_id']})
+    if refund['lease_until'] > time.time():
+        return jsonify({'error': 'Refund already in progress', **refund_to_json(refund)}), 409
+    if refund['state'] == 'failed' and not refund['charge_id']:
+        return jsonify({'error': refund['last_error']}), 404
+    return jsonify({'error': refund['last_error'], **refund_to_json(refund)}), 500
+
+
+@app.route('/api/refunds/<int:order_id>', methods=['GET'])
+def get_refund(order_id):
+    row = load_refund(order_id)
+    if row is None:
+        return jsonify({'error': 'No refund for this order'}), 404
+    return jsonify(refund_to_json(row))
+
+
+@app.route('/api/refunds/batch', methods=['POST'])
+def refund_batch():
+    # {"order_ids": [...]}, e.g. all the orders of a cancelled event. Answers at once, the refunds run in
+    # the REFUND_WORKERS pool and GET /api/refunds/batch/<batch_id> follows them.
+    data = request.get_json(silent=True) or {}
+    order_ids = data.get('order_ids')
+    if (not isinstance(order_ids, list) or not order_ids
+            or not all(isinstance(order_id, int) and not isinstance(order_id, bool) for order_id in order_ids)):
+        return jsonify({'error': 'order_ids must be a non empty list of order ids'}), 400
+    if len(order_ids) > REFUND_BATCH_MAX:
+        return jsonify({'error': f'At most {REFUND_BATCH_MAX} orders per batch'}), 400
+
+    batch_id = uuid.uuid4().hex
+    queued = 0
+    for order_id in dict.fromkeys(order_ids):
+        refund = start_refund(order_id, batch_id)
+        queued += refund['batch_id'] == batch_id
+        refund_executor.submit(run_refund, order_id)
+    return jsonify({'batch_id': batch_id, 'orders': queued}), 202
+
+
+@app.route('/api/refunds/batch/<batch_id>', methods=['GET'])
+def get_refund_batch(batch_id):
+    rows = local_db().execute("SELECT * FROM refunds WHERE batch_id = ? ORDER BY order_id", (batch_id,)).fetchall()
+    if not rows:
+        return jsonify({'error': 'Unknown batch'}), 404
+    states = {}
+    for row in rows:
+        states[row['state']] = states.get(row['state'], 0) + 1
+    return jsonify({'batch_id': batch_id, 'states': states, 'refunds': [refund_to_json(row) for row in rows]})
 
 
 @app.route('/api/user-shop-association', methods=['GET'])
 def user_shop_association():
-    print(f"####### ENDPOINT CALLED: /api/user-shop-association on {datetime.now()}")
     user_id = request.args.get('id')
+    if not user_id and current_user():
+        user_id = str(current_user()['ID'])
     if not user_id:
         return jsonify({'error': 'User ID is required'}), 400
+    if not user_id.isdigit():
+        return jsonify({'error': 'User ID must be a number'}), 400
 
-    # Assuming you have a proper MySQL connection
-    connection = pymysql.connect(host='localhost',
-                                 user='wordpress',
-                                 password='admin123',
-                                 database='wordpress',
-                                 cursorclass=pymysql.cursors.DictCursor)
+    # Fetch the shop association from the user's metadata
+    shop_name = get_shop_association(user_id) or "Not Assigned"
+    return jsonify({'shop_name': shop_name})
 
-    shop_name = "Not Assigned"
-    try:
-        with connection.cursor() as cursor:
-            # Fetch the shop association from the user's metadata
-            sql = "SELECT meta_value FROM wp_usermeta WHERE user_id = %s AND meta_key = 'shop_association'"
-            cursor.execute(sql, (user_id,))
-            result = cursor.fetchone()
-            if result:
-                shop_name = result['meta_value']
-    finally:
-        connection.close()
 
-    return jsonify({'shop_name': shop_name})
+# Max number of users in one page of /api/user-data?limit=
+USER_PAGE_MAX_LIMIT = 500
+
+# Kept in each process: a customer.* webhook clears the entry in the worker that receives it, the
+# other workers pick the change up when their entry expires
+USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT', 60))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 2048))
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache: entries expire `ttl` seconds after being set and the least
+    recently used entry is dropped when more than `maxsize` are stored.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TIMEOUT)
 
 
 @app.route('/api/user-data', methods=['GET'])
 def get_user_data():
-    print(f"####### ENDPOINT CALLED: /api/user-data on {datetime.now()}")
     user_id = request.args.get('username')  # User ID is optional; if not provided, fetch data for all users.
-    users_data = fetch_wordpress_users(user_id)
-    return jsonify(users_data)
+    # ?after=<user id>&limit=<n> pages through the users, all of them by default
+    try:
+        after = int(request.args['after']) if request.args.get('after') else None
+        limit = min(int(request.args['limit']), USER_PAGE_MAX_LIMIT) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'error': 'after and limit must be integers'}), 400
+
+    users_data = fetch_wordpress_users(user_id, after, limit)
+    response = jsonify(users_data)
+    if limit and len(users_data) == limit:
+        response.headers['X-Next-After'] = str(users_data[-1]['id'])
+    return response
+
 
+@lru_cache(maxsize=1024)
+def parse_capabilities(capabilities_blob):
+    # Most users share the same few wp_capabilities values, so each one is only unserialized once
+    capabilities = phpserialize.loads(capabilities_blob.encode(), decode_strings=True)
+    return tuple(role for role, granted in capabilities.items() if granted)
 
-def fetch_wordpress_users(username=None):
-    connection = pymysql.connect(host='localhost',
-                                 user='wordpress',
-                                 password='admin123',
-                                 database='wordpress',
-                                 cursorclass=pymysql.cursors.DictCursor)
 
-    users = []
+def capabilities_roles(capabilities_blob, user_id=None):
+    # The granted roles of a PHP serialized wp_capabilities value
+    if not capabilities_blob:
+        return []
     try:
+        return list(parse_capabilities(capabilities_blob))
+    except Exception as e:
+        app.logger.warning(f"Error deserializing capabilities for user {user_id}: {e}")
+        return ['No Role Assigned']
+
+
+def build_users_query(username=None, user_id=None, after=None, limit=None):
+    # Users with their capabilities and shop association, pivoted from wp_usermeta in one query
+    query = """
+        SELECT u.ID, u.user_login, u.user_email,
+               max(case when m.meta_key = 'wp_capabilities' then m.meta_value end) as capabilities,
+               max(case when m.meta_key = 'shop_association' then m.meta_value end) as shop_association
+        FROM wp_users u
+        LEFT JOIN wp_usermeta m ON u.ID = m.user_id AND m.meta_key IN ('wp_capabilities', 'shop_association')
+        WHERE 1 = 1
+    """
+    params = []
+    if username:
+        query += " AND u.user_login = %s "
+        params.append(username)
+    if user_id is not None:
+        query += " AND u.ID = %s "
+        params.append(user_id)
+    if after is not None:
+        query += " AND u.ID > %s "
+        params.append(after)
+    query += " GROUP BY u.ID ORDER BY u.ID "
+    if limit:
+        query += " LIMIT %s "
+        params.append(limit)
+    return query, params
+
+
+def user_from_row(user):
+    roles = capabilities_roles(user['capabilities'], user['ID'])
+    return {
+        'id': user['ID'],
+        'username': user['user_login'],
+        'email': user['user_email'],
+        'role': roles[0] if roles else 'No Role Assigned',
+        'shop': user['shop_association'] or 'No Shop Assigned'
+    }
+
+
+def fetch_wordpress_users(username=None, after=None, limit=None):
+    with db_connection() as connection:
         with connection.cursor() as cursor:
-            if username:
-                # Fetch user details for a specific username.
-                sql = """
-                    SELECT u.ID, u.user_login, u.user_email, m.meta_value as capabilities 
-                    FROM wp_users u 
-                    LEFT JOIN wp_usermeta m ON u.ID = m.user_id AND m.meta_key = 'wp_capabilities'
-                    WHERE u.user_login = %s
-                """
-                cursor.execute(sql, (username,))
-            else:
-                # Fetch details for all users if no username is specified.
-                sql = """
-                    SELECT u.ID, u.user_login, u.user_email, m.meta_value as capabilities 
-                    FROM wp_users u 
-                    LEFT JOIN wp_usermeta m ON u.ID = m.user_id AND m.meta_key = 'wp_capabilities'
-                """
-                cursor.execute(sql)
-
-            users_basic_info = cursor.fetchall()
-
-            for user in users_basic_info:
-                user_id = user['ID']
-                roles = []
-
-                if user['capabilities']:
-                    try:
-                        capabilities = phpserialize.loads(user['capabilities'].encode(), decode_strings=True)
-                        roles = [role for role, granted in capabilities.items() if granted]
-                    except Exception as e:
-                        print(f"Error deserializing capabilities for user {user_id}: {e}")
-                        roles = ['No Role Assigned']
-
-                cursor.execute(
-                    "SELECT meta_value FROM wp_usermeta WHERE user_id = %s AND meta_key = 'shop_association'",
-                    (user_id,))
-                result = cursor.fetchone()
-                shop_name = result['meta_value'] if result else 'No Shop Assigned'
-
-                users.append({
-                    'id': user_id,
-                    'username': user['user_login'],
-                    'email': user['user_email'],
-                    'role': roles[0] if roles else 'No Role Assigned',
-                    'shop': shop_name
-                })
+            cursor.execute(*build_users_query(username=username, after=after, limit=limit))
+            return [user_from_row(user) for user in cursor.fetchall()]
+
+
+def get_wordpress_user(user_id):
+    """
+    The user's row (ID, user_login, user_email, capabilities, shop_association) or None, from
+    user_cache: every tablet asks for its shop on login, on each Socket.IO connect and in X-User-Id.
+    """
+    user_id = int(user_id)
+    if user_id < 1:
+        return None  # WordPress ids start at 1, there is no user 0 to look up
+    user = user_cache.get(user_id)
+    if user is None:
+        with db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(*build_users_query(user_id=user_id))
+                user = cursor.fetchone() or {}  # unknown users are cached too
+        user_cache.set(user_id, user)
+    return user or None
+
+
+def get_shop_association(user_id):
+    # The store a user works for, from the user's metadata, or None
+    user = get_wordpress_user(user_id)
+    return user['shop_association'] if user else None
+
+
+# ===================== Exports =====================
+
+# Exports stream the rows from MySQL (server side cursor) or the read model straight into the response,
+# a chunk at a time, instead of building the whole list and then the whole JSON document in memory.
+EXPORT_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_CHUNK_SIZE = 1000
+
+
+def stream_orders(statuses, store_name=None, sort='ASC', window=None):
+    # Same orders as get_orders_by_status, yielded one by one
+    if read_model_ready():
+        return read_model_stream_orders(statuses, store_name, sort, window)
+    return started_export(stream_wordpress_orders(statuses, store_name, sort, window))
 
+
+def started_export(rows):
+    """
+    Runs an export's row generator up to its first `yield None`, when its pooled connections are
+    taken and the query is running. Called before the response starts, so a busy pool is still a 503
+    and a failing query a 500 instead of a 200 cut short.
+    """
+    next(rows)
+    return rows
+
+
+def stream_wordpress_orders(statuses, store_name=None, sort='ASC', window=None):
+    # An unbuffered cursor can't run other queries until it is fully read, so the products of each
+    # chunk of orders are loaded through a second connection: the request's own one when it already
+    # holds it, so an export never waits for a third
+    items_connection = g.pop('db_connection', None) or db_pool.checkout()
+    broken = False
+    try:
+        with db_pool.connection() as connection:
+            with connection.cursor(pymysql.cursors.SSDictCursor) as cursor, items_connection.cursor() as items_cursor:
+                storage = order_storage(items_cursor)
+                tz = order_dates_timezone(items_cursor, storage)
+                query, params = storage.build_orders_query(statuses, store_name, sort, window=window_to_gmt(window, tz))
+                cursor.execute(query, params)
+                yield None  # see started_export
+                while True:
+                    orders = rows_to_site_time(cursor.fetchmany(EXPORT_CHUNK_SIZE), tz)
+                    if not orders:
+                        break
+                    products_by_order = {}
+                    if wants_products(window):
+                        products_by_order = fetch_products_for_orders(items_cursor,
+                                                                      [order['order_id'] for order in orders])
+                    for order in orders:
+                        yield project_order(order, products_by_order.get(order['order_id'], []), window)
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+        broken = True
+        raise
     finally:
-        connection.close()
+        db_pool.release(items_connection, broken)
+
+
+def read_model_stream_orders(statuses, store_name=None, sort='ASC', window=None):
+    query, params = build_read_model_orders_query(statuses, store_name, sort, window=window)
+    connection = local_db()
+    cursor = connection.execute(query, params)
+    while True:
+        orders = [read_model_order_row(row) for row in cursor.fetchmany(EXPORT_CHUNK_SIZE)]
+        if not orders:
+            break
+        products_by_order = {}
+        if wants_products(window):
+            products_by_order = read_model_products(connection, [order['order_id'] for order in orders])
+        for order in orders:
+            yield project_order(order, products_by_order.get(order['order_id'], []), window)
+
+
+def stream_wordpress_users():
+    # Same users as fetch_wordpress_users, yielded one by one
+    with db_pool.connection() as connection:
+        with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute(*build_users_query())
+            yield None  # see started_export
+            for user in cursor.fetchall_unbuffered():
+                yield user_from_row(user)
+
+
+def csv_value(value):
+    # Lists (the products of an order) go in one cell as JSON
+    return export_json(value) if isinstance(value, (list, dict)) else value
+
+
+def export_json(row):
+    return app.json.dumps(row, separators=(',', ':'))
+
+
+def export_chunks(rows, export_format):
+    # Encode the rows as they come, a few hundred at a time so the response isn't sent byte by byte
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header = None
+    if export_format == 'json':
+        buffer.write('[')
+
+    for count, row in enumerate(rows):
+        if export_format == 'json':
+            buffer.write((',' if count else '') + export_json(row))
+        elif export_format == 'ndjson':
+            buffer.write(export_json(row) + '\n')
+        else:
+            if header is None:
+                header = list(row)
+                writer.writerow(header)
+            writer.writerow([csv_value(row.get(column)) for column in header])
+
+        if count % 200 == 199:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
 
-    return users
+    if export_format == 'json':
+        buffer.write(']')
+    yield buffer.getvalue()
+
+
+def export_response(rows, export_format, filename):
+    response = Response(stream_with_context(export_chunks(rows, export_format)),
+                        mimetype=EXPORT_FORMATS[export_format])
+    if export_format == 'csv':
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}.csv'
+    return response
+
+
+def get_export_format(my_request):
+    export_format = my_request.args.get('format', 'json').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Invalid format [{export_format}], use one of {', '.join(EXPORT_FORMATS)}"}), 400
+    return export_format
+
+
+@app.route('/api/orders/export', methods=['GET'])
+@app.route('/api/orders/<store_name>/export', methods=['GET'])
+def export_orders(store_name=None):
+    """
+    Back office export of a store's orders (all the stores without one): ?format=json|ndjson|csv,
+    ?status= like /api/orders, plus ?sort=, ?date_from=, ?date_to= and ?fields=.
+    """
+    export_format = get_export_format(request)
+    if isinstance(export_format, tuple):
+        return export_format
+    sort_order = get_sort_asc_desc(request)
+    if isinstance(sort_order, tuple):
+        return sort_order
+    window = parse_order_window(request.args)
+    if isinstance(window, tuple):
+        return window
+
+    store_name = store_name or caller_shop()
+    orders = stream_orders(normalize_statuses(request.args.get('status')), store_name, sort_order, window)
+    return export_response(orders, export_format, f"orders-{store_name or 'all'}")
+
+
+@app.route('/api/user-data/export', methods=['GET'])
+def export_user_data():
+    export_format = get_export_format(request)
+    if isinstance(export_format, tuple):
+        return export_format
+    return export_response(started_export(stream_wordpress_users()), export_format, 'users')
+
+
+# ===================== Product catalogue =====================
+
+PRODUCT_REFRESH_INTERVAL = float(os.environ.get('PRODUCT_REFRESH_INTERVAL', 60))  # seconds between refreshes
+PRODUCT_FULL_RELOAD_INTERVAL = float(os.environ.get('PRODUCT_FULL_RELOAD_INTERVAL', 3600))  # also drops deleted products
+
+
+def product_etag(product):
+    return hashlib.sha1(json.dumps(product, sort_keys=True).encode()).hexdigest()[:20]
+
+
+class ProductCatalogue:
+    """
+    In-memory copy of every WooCommerce product, served to the POS screens without calling WooCommerce.
+
+    All the pages are loaded on first use. After that only the products modified since the last refresh
+    are fetched (modified_after), every `refresh_interval` seconds, with a full reload every
+    `full_reload_interval` seconds. Writes made through this API and product webhooks update it directly.
+
+    Each worker has its own copy, so put() and remove() also leave a token in the shared cache (see cache):
+    the other workers see it changed on their next request and refresh right away instead of serving the old
+    product until `refresh_interval`, a removal with a full reload (modified_after doesn't list deleted products).
+    """
+
+    SHARED_KEYS = ('products:changed', 'products:removed')
+
+    def __init__(self, client, refresh_interval, full_reload_interval):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.products = {}  # id -> product as returned by WooCommerce
+        self.etags = {}  # id -> ETag
+        self._list = None  # products in WooCommerce's default order, rebuilt after a change
+        self._list_etag = None
+        self._last_modified = None  # newest date_modified_gmt seen
+        self._misses = {}  # id -> when WooCommerce last said it doesn't exist
+        self._loaded_at = 0.0
+        self._refreshed_at = 0.0
+        self._shared = {}  # SHARED_KEYS -> token seen at the last refresh
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _fetch_all_pages(self, params):
+        products, page = [], 1
+        while True:
+            response = self.client.get("products", params={**params, 'per_page': 100, 'page': page})
+            if not response.ok:
+                raise WooCommerceUnavailableError(f"Failed to fetch products: {response.status_code}")
+            batch = response.json()
+            products.extend(batch)
+            if not batch or page >= int(response.headers.get('X-WP-TotalPages', 1)):
+                return products
+            page += 1
+
+    def _shared_tokens(self):
+        return dict(zip(self.SHARED_KEYS, cache.get_many(*self.SHARED_KEYS)))
+
+    def _publish(self, key):
+        cache.set(key, uuid.uuid4().hex, timeout=0)
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        shared = self._shared_tokens()
+        written = self._loaded_at and shared != self._shared  # by another worker, or by this one since the refresh
+        if not written and now - self._refreshed_at < self.refresh_interval:
+            return
+        # Only one thread refreshes; the others keep serving the current copy (or wait for the first load)
+        if not self._refresh_lock.acquire(blocking=not self._loaded_at):
+            return
+        try:
+            if not written and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return  # refreshed while we were waiting
+            removed = written and shared['products:removed'] != self._shared.get('products:removed')
+            if not self._loaded_at or removed or now - self._loaded_at >= self.full_reload_interval:
+                self._reload()
+            else:
+                self._refresh_modified()
+        except WooCommerceUnavailableError as e:
+            if not self._loaded_at:
+                raise
+            app.logger.warning(f"Product catalogue refresh failed, serving the cached copy: {e}")
+        finally:
+            if self._loaded_at:
+                self._refreshed_at = time.monotonic()  # also after a failure, to not hammer a struggling site
+                self._shared = shared
+            self._refresh_lock.release()
+
+    def _reload(self):
+        products = self._fetch_all_pages({})
+        with self._lock:
+            self.products = {product['id']: product for product in products}
+            self.etags = {product['id']: product_etag(product) for product in products}
+            self._changed()
+        self._last_modified = max((product.get('date_modified_gmt') or '' for product in products), default=None)
+        self._loaded_at = time.monotonic()
+        app.logger.info(f"Product catalogue loaded: {len(products)} products")
+
+    def _refresh_modified(self):
+        if not self._last_modified:
+            return self._reload()
+        # One second of overlap so a product saved in the same second as the last refresh isn't missed
+        since = datetime.fromisoformat(self._last_modified) - timedelta(seconds=1)
+        for product in self._fetch_all_pages({'modified_after': since.isoformat(), 'dates_are_gmt': 'true'}):
+            self._store(product)
+
+    def _changed(self):
+        self._list = None
+        self._list_etag = None
+
+    def put(self, product):
+        self._store(product)
+        self._publish('products:changed')
+
+    def _store(self, product):
+        with self._lock:
+            self.products[product['id']] = product
+            self.etags[product['id']] = product_etag(product)
+            self._misses.pop(product['id'], None)
+            self._changed()
+        modified = product.get('date_modified_gmt')
+        if modified and (not self._last_modified or modified > self._last_modified):
+            self._last_modified = modified
+
+    def remove(self, product_id):
+        with self._lock:
+            if self.products.pop(product_id, None) is not None:
+                self.etags.pop(product_id, None)
+                self._changed()
+        self._publish('products:removed')
+
+    def get(self, product_id):
+        self.ensure_fresh()
+        product = self.products.get(product_id)
+        if product is None:
+            # Unknown ids are remembered until the next refresh, so a client polling a deleted
+            # product doesn't turn every request into a call to WooCommerce
+            missed_at = self._misses.get(product_id)
+            if missed_at is not None and time.monotonic() - missed_at < self.refresh_interval:
+                return None, None
+            # Maybe created after the last refresh
+            response = self.client.get(f"products/{product_id}")
+            if not response.ok:
+                if response.status_code == 404:
+                    with self._lock:
+                        if len(self._misses) > 10000:
+                            self._misses.clear()
+                        self._misses[product_id] = time.monotonic()
+                return None, None
+            product = response.json()
+            self._store(product)
+        return product, self.etags.get(product_id)
+
+    def all(self):
+        self.ensure_fresh()
+        with self._lock:
+            if self._list is None:
+                # Same order as the WooCommerce API: newest first
+                self._list = sorted(self.products.values(),
+                                    key=lambda product: (product.get('date_created_gmt') or '', product['id']),
+                                    reverse=True)
+                self._list_etag = hashlib.sha1(
+                    ''.join(self.etags[product['id']] for product in self._list).encode()).hexdigest()[:20]
+            return self._list, self._list_etag
+
+
+product_catalogue = ProductCatalogue(wc_client, PRODUCT_REFRESH_INTERVAL, PRODUCT_FULL_RELOAD_INTERVAL)
+
+
+def conditional_json(data, etag):
+    # 304 Not Modified when the client already has this version (If-None-Match)
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
 @app.route('/api/products', methods=['GET'])
 def get_all_product_details():
-    print(f"####### ENDPOINT CALLED: /api/products on {datetime.now()}")
-    response = requests.get(f"{WC_API_URL}/products",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET), verify=False)
-
-    if response.ok:
-        return jsonify(response.json())
-    else:
-        return jsonify({'error': 'Failed to fetch product details'}), response.status_code
+    products, etag = product_catalogue.all()
+    return conditional_json(products, etag)
 
 
 @app.route('/api/product/<int:product_id>', methods=['GET'])
 def get_product_details(product_id):
-    print(f"####### ENDPOINT CALLED: /api/product/<int:product_id> on {datetime.now()}")
-    response = requests.get(f"{WC_API_URL}/products/{product_id}",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                            verify=False)
-    if response.ok:
-        return jsonify(response.json())
-    else:
-        return jsonify({'error': 'Failed to fetch product details'}), response.status_code
+    product_data, etag = product_catalogue.get(product_id)
+    if product_data is None:
+        return jsonify({'error': 'Failed to fetch product details'}), 404
+    return conditional_json(product_data, etag)
 
 
 @app.route('/api/product/<int:product_id>/details', methods=['GET'])
 def get_product_image_price(product_id):
-    print(f"####### ENDPOINT CALLED: /api/product/<int:product_id>/details on {datetime.now()}")
-    response = requests.get(f"{WC_API_URL}/products/{product_id}",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET), verify=False)
-    if response.ok:
-        product_data = response.json()
-        product_details = {
-            'image': product_data['images'][0]['src'] if product_data['images'] else None,
-            'price': product_data['price']
-        }
-        return jsonify(product_details)
-    else:
-        return jsonify({'error': 'Failed to fetch product details'}), response.status_code
+    product_data, etag = product_catalogue.get(product_id)
+    if product_data is None:
+        return jsonify({'error': 'Failed to fetch product details'}), 404
+
+    product_details = {
+        'image': product_data['images'][0]['src'] if product_data['images'] else None,
+        'price': product_data['price']
+    }
+    # Resized copies for the screens (see Product images), 'image' stays the WordPress original
+    variants = product_image_variants(product_data)
+    if variants:
+        product_details['variants'] = variants
+        etag += '-v'  # the body changes once the variants exist
+    return conditional_json(product_details, etag)
 
 
 @app.route('/api/product/<int:product_id>/update-price', methods=['POST'])
 def update_product_price(product_id):
-    print(f"####### ENDPOINT CALLED: /api/product/<int:product_id>/update-price on {datetime.now()}")
     new_price = request.json.get('price')
     if not new_price:
         return jsonify({'error': 'New price is required'}), 400
 
     data_payload = {'regular_price': str(new_price)}
-    response = requests.put(f"{WC_API_URL}/products/{product_id}",
-                            auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                            json=data_payload, verify=False)
+    response = wc_client.put(f"products/{product_id}", json=data_payload)
 
     if response.ok:
+        product_catalogue.put(response.json())
         return jsonify({'success': 'Product price updated'})
     else:
         return jsonify({'error': 'Failed to update product price'}), response.status_code
 
 
+# ===================== Product images =====================
+
+# Uploaded photos are re-encoded into small JPEG variants for the screens, cached on disk under the sha256
+# of the original (the same photo is only processed once) and served by /api/images. Images of products
+# edited in WordPress get their variants too, the first /details of the product fetches them in the background.
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+IMAGE_VARIANTS = {'display': 1280, 'thumbnail': 320}  # longest side in pixels, largest first
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 82))
+IMAGE_UPLOAD_MAX_BYTES = int(os.environ.get('IMAGE_UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))  # images resized at once
+# Hosts the WordPress images are downloaded from, the site of WC_API_URL unless set (e.g. to add a CDN)
+IMAGE_FETCH_HOSTS = set(filter(None, os.environ.get('IMAGE_FETCH_HOSTS', urlparse(WC_API_URL).hostname or '')
+                               .split(',')))
+
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='image')
+# Plain session for the media files: no WooCommerce credentials and certificates checked, unlike wc_client
+image_session = requests.Session()
+_image_fetches = set()  # media ids whose variants are being made
+_image_fetches_lock = threading.Lock()
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def image_variant_path(image_hash, variant):
+    return os.path.join(IMAGE_CACHE_DIR, image_hash[:2], image_hash, f'{variant}.jpg')
+
+
+def off_hub(fn, *args):
+    # Under eventlet the pool threads are green, the Pillow work goes to eventlet's OS threads so it
+    # doesn't hold up every other request
+    if SOCKETIO_ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    return fn(*args)
+
+
+def render_image_variants(data):
+    """JPEG bytes of every IMAGE_VARIANTS size of an image, each made from the previous, larger one."""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEGs are decoded straight at (about) the largest size needed instead of full size
+            largest = max(IMAGE_VARIANTS.values())
+            image.draft('RGB', (largest, largest))
+            image = ImageOps.exif_transpose(image)  # phone photos are stored sideways with a rotation tag
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f'Not a usable image: {e}') from e
+
+    variants = {}
+    for variant, size in IMAGE_VARIANTS.items():
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        variants[variant] = buffer.getvalue()
+    return variants
+
+
+def store_image_variants(data):
+    """
+    Make the variants of an image unless they are cached already. Returns the image's hash and the
+    bytes of its display variant. Runs on the image pool.
+    """
+    image_hash = hashlib.sha256(data).hexdigest()
+    display_path = image_variant_path(image_hash, 'display')
+    if all(os.path.exists(image_variant_path(image_hash, variant)) for variant in IMAGE_VARIANTS):
+        with open(display_path, 'rb') as cached:
+            return image_hash, cached.read()
+
+    variants = off_hub(render_image_variants, data)
+    os.makedirs(os.path.dirname(display_path), exist_ok=True)
+    for variant, content in variants.items():
+        # Written aside and renamed, a reader never sees half a file
+        path = image_variant_path(image_hash, variant)
+        with open(f'{path}.{uuid.uuid4().hex}.tmp', 'wb') as tmp:
+            tmp.write(content)
+        os.replace(tmp.name, path)
+    return image_hash, variants['display']
+
+
+def save_product_image(media_id, image_hash):
+    with local_transaction() as connection:
+        connection.execute("INSERT OR REPLACE INTO product_images (media_id, image_hash, created_at) VALUES (?, ?, ?)",
+                           (media_id, image_hash, time.time()))
+
+
+def fetch_image_variants(media_id, src):
+    # Variants of an image that was added in WordPress, on the image pool
+    try:
+        # Not followed, a redirect could lead anywhere
+        with image_session.get(src, timeout=wc_client.timeout, allow_redirects=False, stream=True) as response:
+            if response.is_redirect:
+                raise requests.RequestException(f"redirected to {response.headers.get('Location')}")
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length') or 0) > IMAGE_UPLOAD_MAX_BYTES:
+                raise InvalidImageError(f"larger than {IMAGE_UPLOAD_MAX_BYTES} bytes")
+            # Read up to the upload limit, a larger (or endless) body is dropped without being held in memory
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > IMAGE_UPLOAD_MAX_BYTES:
+                    raise InvalidImageError(f"larger than {IMAGE_UPLOAD_MAX_BYTES} bytes")
+        image_hash, _ = store_image_variants(bytes(content))
+        save_product_image(media_id, image_hash)
+    except (requests.RequestException, InvalidImageError) as e:
+        app.logger.warning(f"No variants for image {media_id} ({src}): {e}")
+    finally:
+        with _image_fetches_lock:
+            _image_fetches.discard(media_id)
+
+
+def is_wordpress_image(src):
+    url = urlparse(src)
+    return url.scheme in ('http', 'https') and url.hostname in IMAGE_FETCH_HOSTS
+
+
+def product_image_variants(product):
+    """
+    URLs of the variants of a product's first image, None while they don't exist yet (they are then
+    requested, the next call has them).
+    """
+    images = product.get('images') or []
+    if not images or not images[0].get('id'):
+        return None
+    media_id = images[0]['id']
+    row = local_db().execute("SELECT image_hash FROM product_images WHERE media_id = ?", (media_id,)).fetchone()
+    if row:
+        return {variant: f"/api/images/{row['image_hash']}/{variant}.jpg" for variant in IMAGE_VARIANTS}
+
+    # Images hosted elsewhere are served as they are, only the site's own are downloaded
+    if images[0].get('src') and is_wordpress_image(images[0]['src']):
+        with _image_fetches_lock:
+            if media_id in _image_fetches:
+                return None
+            _image_fetches.add(media_id)
+        image_executor.submit(fetch_image_variants, media_id, images[0]['src'])
+    return None
+
+
+@app.route('/api/images/<image_hash>/<variant>.jpg', methods=['GET'])
+def get_image_variant(image_hash, variant):
+    # Open like / (img tags can't send the token); the hash names the content so it can be cached forever
+    if variant not in IMAGE_VARIANTS or not re.fullmatch(r'[0-9a-f]{64}', image_hash):
+        abort(404)
+    path = image_variant_path(image_hash, variant)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='image/jpeg', max_age=365 * 24 * 3600, etag=image_hash[:20] + variant)
+
+
 @app.route('/api/product/<int:product_id>/update-image', methods=['POST'])
 def update_product_image(product_id):
-    print(f"####### ENDPOINT CALLED: /api/product/<int:product_id>/update-image on {datetime.now()}")
+    if request.content_length and request.content_length > IMAGE_UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'The image is larger than {IMAGE_UPLOAD_MAX_BYTES} bytes'}), 413
+
     # Check if the post request has the file part
     if 'file' not in request.files:
         return jsonify({'error': 'No file part in the request'}), 400
@@ -637,17 +3541,16 @@ def update_product_image(product_id):
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    # Save the file temporarily on the server
-    filename = file.filename
-    filepath = os.path.join('/tmp', filename)
-    file.save(filepath)
+    # The upload is read straight from the request and resized on the image pool, nothing goes through /tmp
+    try:
+        image_hash, display = image_executor.submit(store_image_variants, file.read()).result()
+    except InvalidImageError as e:
+        return jsonify({'error': str(e)}), 400
 
-    # Upload the image to WordPress/WooCommerce
-    with open(filepath, 'rb') as img:
-        media_response = requests.post(f"{WC_API_URL}/media",
-                                       auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                                       files={'file': img},
-                                       headers={'Content-Disposition': f'attachment; filename={filename}'})
+    # Upload the image to WordPress/WooCommerce, its display variant: nobody needs the full size photo
+    filename = f"{os.path.splitext(secure_filename(file.filename))[0] or f'product-{product_id}'}.jpg"
+    media_response = wc_client.post("media", files={'file': (filename, display, 'image/jpeg')},
+                                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
     if not media_response.ok:
         return jsonify({'error': 'Failed to upload image to WordPress'}), media_response.status_code
@@ -655,17 +3558,18 @@ def update_product_image(product_id):
     # Get the ID of the uploaded image
     media_response_data = media_response.json()
     image_id = media_response_data['id']
+    save_product_image(image_id, image_hash)
 
     # Now update the product with the new image ID
-    update_response = requests.put(f"{WC_API_URL}/products/{product_id}",
-                                   auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET),
-                                   json={'images': [{'id': image_id}]},
-                                   verify=False)
+    update_response = wc_client.put(f"products/{product_id}", json={'images': [{'id': image_id}]})
 
     if not update_response.ok:
         return jsonify({'error': 'Failed to update product image'}), update_response.status_code
 
-    return jsonify({'success': 'Product image updated'})
+    product_catalogue.put(update_response.json())
+
+    return jsonify({'success': 'Product image updated',
+                    'variants': {variant: f"/api/images/{image_hash}/{variant}.jpg" for variant in IMAGE_VARIANTS}})
 
 
 def get_sort_asc_desc(my_request):
@@ -679,17 +3583,224 @@ def get_sort_asc_desc(my_request):
     return sort_param
 
 
+# ===================== Index advisor =====================
+
+# Composite indexes for the meta lookups of this API. Stock WordPress only has single column (prefix)
+# indexes on the meta tables, so e.g. the store_name filter reads every store_name row of wp_postmeta.
+WORDPRESS_INDEXES = [
+    # store_name = %s in the order listings: the post ids come straight from the index
+    ('wp_postmeta', 'skipy_meta_key_value', 'meta_key(191), meta_value(64), post_id'),
+    # meta pivot of an order and its _transaction_id
+    ('wp_postmeta', 'skipy_post_meta_key', 'post_id, meta_key(191)'),
+    # _product_id/_qty/_line_total of the line items
+    ('wp_woocommerce_order_itemmeta', 'skipy_item_meta_key', 'order_item_id, meta_key(191)'),
+    # wp_capabilities/shop_association of the users
+    ('wp_usermeta', 'skipy_user_meta_key', 'user_id, meta_key(191)'),
+    # orders changed since a date, for /api/orders/<store_name>/changes (HPOS has its date_updated index)
+    ('wp_posts', 'skipy_posts_type_modified', 'post_type, post_modified_gmt'),
+]
+
+
+def advisor_queries(cursor, store_name):
+    # The SQL this app runs against WordPress, with real parameters taken from the database
+    storage = order_storage(cursor)
+    cursor.execute(storage.order_ids_query)
+    order_ids = [row['ID'] for row in cursor.fetchall()] or [0]
+    cursor.execute("SELECT ID FROM wp_users ORDER BY ID LIMIT 1")
+    user = cursor.fetchone()
+    page = {'after': None, 'limit': 50, 'date_from': None, 'date_to': None, 'fields': None}
+    return {
+        'open orders of a store': storage.build_orders_query(OPEN_ORDER_STATUSES, store_name),
+        'completed orders of a store, first page': storage.build_orders_query(('wc-completed',), store_name,
+                                                                              'DESC', window=page),
+        'one order': storage.build_orders_query((), order_ids=order_ids[:1]),
+        'orders of a store changed in the last hour': storage.changed_orders_query(
+            store_name, ((datetime.utcnow() - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'), 0),
+            datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), ORDER_CHANGES_PAGE_SIZE + 1),
+        'line items of 100 orders': build_order_items_query(order_ids),
+        'stripe charge of an order': (storage.stripe_charge_query, [order_ids[0]]),
+        'all users': build_users_query(),
+        'one user': build_users_query(user_id=user['ID'] if user else 0),
+    }
+
+
+def existing_indexes(cursor, table):
+    cursor.execute(f"SHOW INDEX FROM {table}")
+    return {row['Key_name'] for row in cursor.fetchall()}
+
+
+def explain_plans(cursor, store_name):
+    # {name: EXPLAIN rows} of every advisor query
+    plans = {}
+    for name, (query, params) in advisor_queries(cursor, store_name).items():
+        cursor.execute("EXPLAIN " + query, params)
+        plans[name] = cursor.fetchall()
+    return plans
+
+
+def is_full_scan(step):
+    # ALL is a table scan, index a scan of a whole index
+    return step['type'] in ('ALL', 'index')
+
+
+def plan_step(step, rows=True):
+    line = f"{'FULL SCAN ' if is_full_scan(step) else ''}{step['table']}: type={step['type']} key={step['key']}"
+    return f"{line} rows={step['rows']} {step['Extra'] or ''}" if rows else line
+
+
+def print_plan_changes(before, after):
+    # Only the queries whose plan changed (the row counts are estimates and move on their own)
+    changed = 0
+    for name, plan in after.items():
+        old = before.get(name, [])
+        if [plan_step(step, rows=False) for step in old] == [plan_step(step, rows=False) for step in plan]:
+            continue
+        changed += 1
+        print(f"####### plan of {name}")
+        for step in old:
+            print(f"  before {plan_step(step)}")
+        for step in plan:
+            print(f"  after  {plan_step(step)}")
+    print(f"####### {changed} plans changed, {sum(map(is_full_scan, sum(after.values(), [])))} full scans")
+
+
+@app.cli.group('db-indexes')
+def db_indexes():
+    """Check the WordPress queries of this API with EXPLAIN and manage their indexes."""
+
+
+@db_indexes.command('report')
+@click.option('--store', default='Snack', help='Store used in the order queries.')
+@click.option('--repeat', default=5, help='Runs of each query for the timings, 0 to skip them.')
+def db_indexes_report(store, repeat):
+    """EXPLAIN every query, flag full scans and time them."""
+    full_scans = 0
+    with db_pool.connection() as connection:
+        with connection.cursor() as cursor:
+            queries = advisor_queries(cursor, store)
+            for name, plan in explain_plans(cursor, store).items():
+                timing = ''
+                if repeat:
+                    query, params = queries[name]
+                    started = time.perf_counter()
+                    for _ in range(repeat):
+                        cursor.execute(query, params)
+                        cursor.fetchall()
+                    timing = f" {(time.perf_counter() - started) / repeat * 1000:.1f}ms"
+                print(f"####### {name}{timing}")
+
+                for step in plan:
+                    full_scans += is_full_scan(step)
+                    print(f"  {plan_step(step)}")
+
+            for table, name, columns in WORDPRESS_INDEXES:
+                state = 'present' if name in existing_indexes(cursor, table) else 'missing'
+                print(f"####### index {name} on {table} ({columns}): {state}")
+
+    print(f"####### {full_scans} full scans")
+
+
+def alter_indexes(statements, dry_run, store):
+    # Runs the ALTER TABLEs and prints the query plans that changed because of them
+    with db_pool.connection() as connection:
+        with connection.cursor() as cursor:
+            statements = statements(cursor)
+            for statement in statements:
+                print(f"####### {statement}")
+            if dry_run or not statements:
+                return
+            before = explain_plans(cursor, store)
+            for statement in statements:
+                started = time.time()
+                cursor.execute(statement)
+                print(f"####### done in {time.time() - started:.1f}s: {statement}")
+            print_plan_changes(before, explain_plans(cursor, store))
+
+
+@db_indexes.command('create')
+@click.option('--dry-run', is_flag=True, help='Only print the statements.')
+@click.option('--store', default='Snack', help='Store used in the order queries of the EXPLAIN comparison.')
+def db_indexes_create(dry_run, store):
+    """Create the missing indexes of WORDPRESS_INDEXES (online, the tables stay writable)."""
+    alter_indexes(lambda cursor: [
+        f"ALTER TABLE {table} ADD INDEX {name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE"
+        for table, name, columns in WORDPRESS_INDEXES if name not in existing_indexes(cursor, table)
+    ], dry_run, store)
+
+
+@db_indexes.command('drop')
+@click.option('--dry-run', is_flag=True, help='Only print the statements.')
+@click.option('--store', default='Snack', help='Store used in the order queries of the EXPLAIN comparison.')
+def db_indexes_drop(dry_run, store):
+    """Drop the indexes created by `db-indexes create`."""
+    alter_indexes(lambda cursor: [
+        f"ALTER TABLE {table} DROP INDEX {name}, ALGORITHM=INPLACE, LOCK=NONE"
+        for table, name, _ in WORDPRESS_INDEXES if name in existing_indexes(cursor, table)
+    ], dry_run, store)
+
+
 # ===================== SocketIO event handlers =====================
 
-@socketio.on('connect', namespace='/ws')
-def connect():
-    print("A client connected")
+def current_store_room():
+    return next((room for room in rooms() if room.startswith('store:')), None)
+
+
+def join_store_room(store_name):
+    current = current_store_room()
+    if current and current != store_room(store_name):
+        leave_room(current)
+    join_room(store_room(store_name))
+    return store_name
+
+
+def connect(auth=None):
+    # The store comes from ?store=<name>, the auth payload or the shop_association of the user
+    # (?user_id=<id>, auth user_id or X-User-Id). The before_request hooks don't run for Socket.IO, so
+    # the API token is checked here: {token: <SEC_KEY>} in the auth payload or the Authorization header.
+    # Without it the connection is refused, before joining a room or replaying any order.
+    auth = auth if isinstance(auth, dict) else {}
+    token = auth.get('token')
+    if not has_api_token(f"Bearer {token}" if token else request.headers.get('Authorization')):
+        app.logger.warning(f"Socket.IO connection to {request.namespace} refused: no valid API token")
+        return False
+    store_name = request.args.get('store') or auth.get('store')
+    user_id = str(request.args.get('user_id') or auth.get('user_id') or request.headers.get('X-User-Id', ''))
+    if not store_name and user_id.isdigit():
+        store_name = get_shop_association(user_id)
+    join_store_room(store_name)
+    request_metrics.socket_connected(request.namespace, 1)
+    app.logger.debug(f"A client connected to {store_room(store_name)}")
 
 
-@socketio.on('disconnect', namespace='/ws')
 def disconnect():
-    print('Client disconnected')
+    request_metrics.socket_connected(request.namespace, -1)
+    app.logger.debug('Client disconnected')
+
+
+def join_store(data):
+    # Switch the client to another store, e.g. when the user logs in after connecting
+    store_name = (data or {}).get('store') if isinstance(data, dict) else data
+    return {'room': store_room(join_store_room(store_name))}
+
+
+def order_deltas_since(data):
+    # On reconnect the client sends the last seq it applied and gets the missed events as the ack
+    try:
+        since = int((data or {}).get('since', 0))
+    except (TypeError, ValueError, AttributeError):
+        return {'error': 'since must be an integer'}
+    room = current_store_room()
+    store_name = room.removeprefix('store:') if room and room != ALL_STORES_ROOM else None
+    return get_order_deltas(since, store_name=store_name)
+
+
+for _namespace in SOCKETIO_NAMESPACES:
+    socketio.on_event('connect', connect, namespace=_namespace)
+    socketio.on_event('disconnect', disconnect, namespace=_namespace)
+    socketio.on_event('join_store', join_store, namespace=_namespace)
+    socketio.on_event('order_deltas_since', order_deltas_since, namespace=_namespace)
 
 
 if __name__ == '__main__':
+    start_background_workers()
     socketio.run(app, debug=True, host='0.0.0.0', port=7000, keyfile='/root/ssl/key.pem', certfile='/root/ssl/cert.pem')
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# Production entry point: a single eventlet process serves the HTTP routes and the Socket.IO
+# connections as green threads instead of one OS thread each.
+#
+# monkey_patch() has to run before app is imported: it makes the sockets of pymysql and requests,
+# the pool locks/queues and the background worker threads of app.py cooperative, so a slow
+# WooCommerce call or MySQL query only parks its own request. DB_POOL_SIZE and WC_POOL_SIZE still
+# bound how many of them hit MySQL/WooCommerce at once.
+#
+#   python findforme_async.py    (behind Apache, see findforme-le-ssl.conf)
+import eventlet
+
+eventlet.monkey_patch()
+
+import os  # noqa: E402
+
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'eventlet')
+
+from app import app, socketio, start_background_workers  # noqa: E402
+
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 7000))
+
+# Apache terminates TLS, set both to serve HTTPS directly
+SSL_KEYFILE = os.environ.get('SSL_KEYFILE')
+SSL_CERTFILE = os.environ.get('SSL_CERTFILE')
+
+if __name__ == '__main__':
+    print(f'####### Starting eventlet server on {HOST}:{PORT}')
+    start_background_workers()
+    ssl_args = {'keyfile': SSL_KEYFILE, 'certfile': SSL_CERTFILE} if SSL_KEYFILE and SSL_CERTFILE else {}
+    socketio.run(app, host=HOST, port=PORT, log_output=False, **ssl_args)
@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOCAL_DB_PATH', os.path.join(tempfile.mkdtemp(), 'skipy.db'))
+
+# app.py initializes firebase_admin with the service account of the server at import time
+with mock.patch('firebase_admin.credentials.Certificate'), mock.patch('firebase_admin.initialize_app'):
+    import app as app_module  # noqa: E402
+
+# DATETIME columns come back as datetime objects, like pymysql returns them
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(sep=' '))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+
+class SQLiteCursor:
+    """The part of a pymysql DictCursor the order queries use, on top of SQLite."""
+
+    def __init__(self, connection):
+        self.cursor = connection.cursor()
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace('%s', '?'), tuple(params or ()))
+
+    def _row(self, row):
+        return dict(zip([column[0] for column in self.cursor.description], row))
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return self._row(row) if row is not None else None
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def wordpress_db():
+    connection = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+    yield connection
+    connection.close()
@@ -0,0 +1,93 @@
+from flask import Flask
+from flask_caching import Cache
+
+import pytest
+
+
+@pytest.fixture
+def workers(app, tmp_path, monkeypatch):
+    """
+    Two workers as two processes would see them: each with its own cache client and single flight,
+    on the same FileSystemCache directory. use(name) makes the app run as that worker.
+    """
+    clients = {name: Cache(Flask(name), config={'CACHE_TYPE': 'FileSystemCache', 'CACHE_DIR': str(tmp_path),
+                                                 'CACHE_KEY_PREFIX': 'skipy:'})
+               for name in ('a', 'b')}
+    flights = {name: app.SingleFlight(app.ORDER_SINGLE_FLIGHT_WINDOW) for name in clients}
+
+    def use(name):
+        monkeypatch.setattr(app, 'cache', clients[name])
+        monkeypatch.setattr(app, 'order_flights', flights[name])
+    return use
+
+
+@pytest.fixture
+def wordpress(app, monkeypatch):
+    # The orders of each (store, status), and how many times the workers had to load a listing
+    orders = {('Pub', 'wc-processing'): [1, 2], ('Pub', 'wc-ready'): [3], ('Snack', 'wc-processing'): [4]}
+    loads = []
+
+    def get_orders_by_status(statuses, store_name, sort='ASC', window=None):
+        loads.append((store_name, statuses))
+        return sorted(order_id for (store, status), order_ids in orders.items() for order_id in order_ids
+                      if (store_name is None or store == store_name) and (not statuses or status in statuses))
+    monkeypatch.setattr(app, 'get_orders_by_status', get_orders_by_status)
+    return orders, loads
+
+
+def test_listing_is_shared_between_workers(app, workers, wordpress):
+    _, loads = wordpress
+    workers('a')
+    assert app.get_cached_orders('wc-processing', 'Pub') == [1, 2]
+    workers('b')
+    assert app.get_cached_orders('wc-processing', 'Pub') == [1, 2]
+    assert len(loads) == 1
+
+
+def test_invalidation_in_one_worker_reaches_the_other(app, workers, wordpress):
+    orders, loads = wordpress
+    for worker in ('a', 'b'):
+        workers(worker)
+        app.get_cached_orders('wc-processing', 'Pub')
+        app.get_cached_orders('wc-ready', 'Pub')
+        app.get_cached_orders('wc-processing', None)
+
+    # Order 2 moves to ready, worker a gets the webhook
+    orders[('Pub', 'wc-processing')].remove(2)
+    orders[('Pub', 'wc-ready')].append(2)
+    workers('a')
+    app.invalidate_order_listings('Pub', ('wc-processing', 'wc-ready'))
+
+    workers('b')
+    assert app.get_cached_orders('wc-processing', 'Pub') == [1]
+    assert app.get_cached_orders('wc-ready', 'Pub') == [2, 3]
+    assert app.get_cached_orders('wc-processing', None) == [1, 4]  # the listing of all the stores too
+    assert len(loads) == 3 + 3
+
+
+def test_invalidation_keeps_the_other_listings(app, workers, wordpress):
+    _, loads = wordpress
+    workers('a')
+    app.get_cached_orders('wc-processing', 'Snack')
+    app.get_cached_orders('wc-ready', 'Pub')
+
+    workers('b')
+    app.invalidate_order_listings('Pub', ('wc-processing',))
+    workers('a')
+    app.get_cached_orders('wc-processing', 'Snack')
+    app.get_cached_orders('wc-ready', 'Pub')
+    assert len(loads) == 2
+
+
+def test_flush_evicts_every_listing_of_the_store(app, workers, wordpress):
+    _, loads = wordpress
+    workers('a')
+    app.get_cached_orders('wc-ready', 'Pub')
+    app.get_cached_orders(['wc-processing', 'wc-ready'], 'Pub')
+
+    workers('b')
+    app.invalidate_order_listings('Pub', None)
+    workers('a')
+    app.get_cached_orders('wc-ready', 'Pub')
+    app.get_cached_orders(['wc-processing', 'wc-ready'], 'Pub')
+    assert len(loads) == 4
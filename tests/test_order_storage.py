@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from conftest import SQLiteCursor
+
+WORDPRESS_SCHEMA = """
+CREATE TABLE wp_options (option_name TEXT, option_value TEXT);
+CREATE TABLE wp_posts (ID INTEGER PRIMARY KEY, post_date DATETIME, post_date_gmt DATETIME, post_status TEXT,
+                       post_type TEXT, post_modified_gmt DATETIME);
+CREATE TABLE wp_postmeta (meta_id INTEGER PRIMARY KEY, post_id INTEGER, meta_key TEXT, meta_value TEXT);
+CREATE TABLE wp_wc_orders (id INTEGER PRIMARY KEY, status TEXT, type TEXT, date_created_gmt DATETIME,
+                           date_updated_gmt DATETIME, total_amount TEXT, payment_method_title TEXT,
+                           transaction_id TEXT);
+CREATE TABLE wp_wc_order_addresses (id INTEGER PRIMARY KEY, order_id INTEGER, address_type TEXT,
+                                    first_name TEXT, last_name TEXT, email TEXT, phone TEXT);
+CREATE TABLE wp_wc_orders_meta (id INTEGER PRIMARY KEY, order_id INTEGER, meta_key TEXT, meta_value TEXT);
+CREATE TABLE wp_woocommerce_order_items (order_item_id INTEGER PRIMARY KEY, order_id INTEGER,
+                                         order_item_name TEXT, order_item_type TEXT);
+CREATE TABLE wp_woocommerce_order_itemmeta (meta_id INTEGER PRIMARY KEY, order_item_id INTEGER,
+                                            meta_key TEXT, meta_value TEXT);
+"""
+
+# Order dates in GMT: around midnight in winter and in summer, so the site time is on another day
+# than GMT, and on both sides of the DST changes (not inside the repeated hour, which post_date
+# can't tell apart either)
+ORDER_DATES_GMT = [
+    datetime(2024, 1, 14, 22, 30),
+    datetime(2024, 1, 14, 23, 45),
+    datetime(2024, 1, 15, 0, 15),
+    datetime(2024, 1, 15, 12, 0),
+    datetime(2024, 3, 30, 23, 30),
+    datetime(2024, 3, 31, 3, 0),
+    datetime(2024, 7, 1, 21, 59),
+    datetime(2024, 7, 1, 22, 0),
+    datetime(2024, 7, 1, 23, 30),
+    datetime(2024, 10, 26, 23, 0),
+    datetime(2024, 10, 27, 3, 0),
+    datetime(2024, 12, 31, 23, 30),
+]
+STORES = ['Snack', 'Pub', 'Pizzaria']
+STATUSES = ['wc-processing', 'wc-preparing', 'wc-ready', 'wc-completed']
+
+# (timezone_string, gmt_offset) as WordPress saves them: a named zone, or only a manual offset
+SITE_TIMEZONES = {
+    'named zone': ('Europe/Madrid', '1', ZoneInfo('Europe/Madrid')),
+    'manual offset': ('', '-3.5', timezone(timedelta(hours=-3.5))),
+}
+
+
+def seed(connection, timezone_string, gmt_offset, tz):
+    """The same orders in the posts tables (site time) and the HPOS tables (GMT)."""
+    connection.executescript(WORDPRESS_SCHEMA)
+    connection.executemany("INSERT INTO wp_options VALUES (?, ?)",
+                           [('timezone_string', timezone_string), ('gmt_offset', gmt_offset)])
+    item_id = 0
+    for order_id, created_gmt in enumerate(ORDER_DATES_GMT, start=1):
+        created = created_gmt.replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None)
+        status, store = STATUSES[order_id % len(STATUSES)], STORES[order_id % len(STORES)]
+        total, first_name = f'{order_id}.50', f'Customer {order_id}'
+        connection.execute("INSERT INTO wp_posts VALUES (?, ?, ?, ?, 'shop_order', ?)",
+                           (order_id, created, created_gmt, status, created_gmt))
+        connection.executemany("INSERT INTO wp_postmeta (post_id, meta_key, meta_value) VALUES (?, ?, ?)", [
+            (order_id, '_billing_first_name', first_name), (order_id, '_billing_last_name', 'Doe'),
+            (order_id, '_billing_email', f'{order_id}@example.com'), (order_id, '_billing_phone', '600000000'),
+            (order_id, '_order_total', total), (order_id, 'store_name', store),
+            (order_id, '_payment_method_title', 'Card'), (order_id, '_transaction_id', f'ch_{order_id}'),
+        ])
+        connection.execute("INSERT INTO wp_wc_orders VALUES (?, ?, 'shop_order', ?, ?, ?, 'Card', ?)",
+                           (order_id, status, created_gmt, created_gmt, total, f'ch_{order_id}'))
+        connection.execute("INSERT INTO wp_wc_order_addresses (order_id, address_type, first_name, last_name, "
+                           "email, phone) VALUES (?, 'billing', ?, 'Doe', ?, '600000000')",
+                           (order_id, first_name, f'{order_id}@example.com'))
+        connection.execute("INSERT INTO wp_wc_orders_meta (order_id, meta_key, meta_value) VALUES (?, 'store_name', ?)",
+                           (order_id, store))
+        for product_id in range(order_id % 3 + 1):
+            item_id += 1
+            connection.execute("INSERT INTO wp_woocommerce_order_items VALUES (?, ?, ?, 'line_item')",
+                               (item_id, order_id, f'Product {product_id}'))
+            connection.executemany("INSERT INTO wp_woocommerce_order_itemmeta (order_item_id, meta_key, meta_value) "
+                                   "VALUES (?, ?, ?)", [(item_id, '_product_id', str(product_id)),
+                                                         (item_id, '_qty', '2'), (item_id, '_line_total', '3.00')])
+
+
+@pytest.fixture(params=list(SITE_TIMEZONES))
+def site(request, app, wordpress_db, monkeypatch):
+    timezone_string, gmt_offset, tz = SITE_TIMEZONES[request.param]
+    seed(wordpress_db, timezone_string, gmt_offset, tz)
+    monkeypatch.setattr(app, '_site_timezone', None)
+
+    def list_orders(storage, statuses=(), store_name=None, sort='ASC', order_ids=None, window=None):
+        # The orders as the API returns them, read from one storage
+        monkeypatch.setattr(app, 'ORDER_STORAGE', storage)
+        with app.app.app_context():
+            orders, products = app.query_wordpress_orders(SQLiteCursor(wordpress_db), statuses, store_name, sort,
+                                                          order_ids, window)
+            return [app.project_order(order, products.get(order['order_id'], []), window) for order in orders]
+    return list_orders, tz
+
+
+def window(**values):
+    return {'after': None, 'limit': None, 'date_from': None, 'date_to': None, 'fields': None} | values
+
+
+def test_site_timezone_from_wp_options(app, site, wordpress_db):
+    _, tz = site
+    assert app.site_timezone(SQLiteCursor(wordpress_db)) == tz
+
+
+def test_hpos_dates_are_site_time(site):
+    list_orders, tz = site
+    orders = list_orders('hpos')
+    assert [order['DATE'] for order in orders] == [
+        created.replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None) for created in ORDER_DATES_GMT]
+
+
+@pytest.mark.parametrize('arguments', [
+    {},
+    {'statuses': ('wc-processing', 'wc-ready')},
+    {'store_name': 'Pub', 'sort': 'DESC'},
+    {'order_ids': [2, 7, 11]},
+    {'window': window(after=3, limit=4)},
+    {'window': window(after=9, limit=3), 'sort': 'DESC'},
+    {'window': window(fields=('ORDER_ID', 'DATE', 'TOTAL'))},
+])
+def test_listings_match(site, arguments):
+    list_orders, _ = site
+    posts = list_orders('posts', **arguments)
+    assert posts
+    assert list_orders('hpos', **arguments) == posts
+
+
+@pytest.mark.parametrize('date_from, date_to', [
+    # whole days in site time, the orders close to midnight are on the GMT day before or after
+    (datetime(2024, 1, 15), datetime(2024, 1, 16)),
+    (datetime(2024, 7, 1), datetime(2024, 7, 2)),
+    (datetime(2024, 7, 2), datetime(2024, 7, 3)),
+    (datetime(2024, 12, 31), datetime(2025, 1, 1)),
+    # across the DST changes
+    (datetime(2024, 3, 30, 12), datetime(2024, 4, 1)),
+    (datetime(2024, 10, 26, 12), datetime(2024, 10, 28)),
+    # open ended
+    (datetime(2024, 7, 1, 23, 59), None),
+    (None, datetime(2024, 1, 15, 1)),
+])
+def test_date_filters_match(site, date_from, date_to):
+    list_orders, _ = site
+    page = window(date_from=date_from, date_to=date_to)
+    posts = list_orders('posts', window=page)
+    assert list_orders('hpos', window=page) == posts
+    assert all((not date_from or order['DATE'] >= date_from) and (not date_to or order['DATE'] < date_to)
+               for order in posts)
@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+import stripe
+
+
+def wc_response(ok=True, status_code=200):
+    return SimpleNamespace(ok=ok, status_code=status_code, text='', json=lambda: {'id': 1, 'status': 'refunded'})
+
+
+@pytest.fixture
+def refunds(app, monkeypatch):
+    # A charge for every order, Stripe and WooCommerce mocked; the tests set what they answer
+    with app.local_transaction() as connection:
+        connection.execute("DELETE FROM refunds")
+        connection.execute("DELETE FROM status_outbox")
+    monkeypatch.setattr(app, 'get_order_stripe_charge_id', lambda order_id: f'ch_{order_id}')
+    monkeypatch.setattr(app, 'sync_order_change', mock.Mock())
+    wc = SimpleNamespace(put=mock.Mock(return_value=wc_response()))
+    monkeypatch.setattr(app, 'wc_client', wc)
+    create = mock.Mock(return_value=SimpleNamespace(id='re_1', status='succeeded'))
+    listing = mock.Mock(return_value=SimpleNamespace(data=[]))
+    monkeypatch.setattr(stripe.Refund, 'create', create)
+    monkeypatch.setattr(stripe.Refund, 'list', listing)
+    return SimpleNamespace(wc=wc, create=create, list=listing)
+
+
+def refund(app, order_id):
+    app.start_refund(order_id)
+    return app.process_refund(order_id)
+
+
+def test_refund_completes(app, refunds):
+    row = refund(app, 1)
+    assert (row['state'], row['stripe_refund_id'], row['last_error']) == ('completed', 're_1', None)
+    refunds.create.assert_called_once_with(charge='ch_1', idempotency_key='refund-order-1')
+    refunds.wc.put.assert_called_once_with('orders/1', json={'status': 'refunded'})
+
+
+def test_connection_error_keeps_the_key_and_takes_over_the_refund(app, refunds):
+    refunds.create.side_effect = stripe.error.APIConnectionError('timed out')
+    row = refund(app, 2)
+    assert (row['state'], row['idempotency_key']) == ('pending', 'refund-order-2')
+
+    # Stripe did refund it: the next attempt finds that refund instead of creating another one
+    refunds.list.return_value = SimpleNamespace(data=[SimpleNamespace(id='re_2', status='succeeded')])
+    row = app.process_refund(2)
+    assert (row['state'], row['stripe_refund_id']) == ('completed', 're_2')
+    assert refunds.create.call_count == 1
+
+
+def test_api_error_retries_with_a_new_key(app, refunds):
+    # Stripe replays a 500 for its key, the retry must not reuse it
+    refunds.create.side_effect = [stripe.error.APIError('internal error'),
+                                  SimpleNamespace(id='re_3', status='succeeded')]
+    row = refund(app, 3)
+    assert row['state'] == 'pending'
+    assert row['idempotency_key'] != 'refund-order-3'
+
+    row = app.process_refund(3)
+    assert (row['state'], row['stripe_refund_id']) == ('completed', 're_3')
+    assert refunds.create.call_args.kwargs['idempotency_key'] == row['idempotency_key']
+
+
+def test_idempotency_conflict_stays_pending(app, refunds):
+    # 409: another request with the same key is still running in Stripe
+    refunds.create.side_effect = stripe.error.IdempotencyError('request in progress')
+    row = refund(app, 4)
+    assert (row['state'], row['idempotency_key']) == ('pending', 'refund-order-4')
+
+
+def test_refused_refund_fails_and_starts_over(app, refunds):
+    refunds.create.side_effect = stripe.error.InvalidRequestError('no such charge', 'charge')
+    assert refund(app, 5)['state'] == 'failed'
+
+    refunds.create.side_effect = None
+    row = refund(app, 5)
+    assert row['state'] == 'completed'
+    assert refunds.create.call_args.kwargs['idempotency_key'] != 'refund-order-5'
+
+
+def test_woocommerce_down_is_recovered_without_refunding_again(app, refunds):
+    refunds.wc.put.side_effect = app.WooCommerceUnavailableError('timed out')
+    row = refund(app, 6)
+    assert (row['state'], row['stripe_refund_id']) == ('stripe_refunded', 're_1')
+
+    refunds.wc.put.side_effect = None
+    assert app.process_refund(6)['state'] == 'completed'
+    assert refunds.create.call_count == 1
+
+
+def test_running_refund_is_not_claimed_twice(app, refunds):
+    app.start_refund(7)
+    assert app.claim_refund(7) is not None
+    assert app.claim_refund(7) is None
+    assert app.process_refund(7)['state'] == 'pending'
+    refunds.create.assert_not_called()
+
+
+def test_refund_supersedes_queued_status_transition(app, refunds):
+    # A transition still waiting in the outbox would be pushed after 'refunded' and move the order back
+    with app.local_transaction() as connection:
+        connection.execute("INSERT INTO status_outbox (order_id, status, next_attempt_at, queued_at) "
+                           "VALUES (8, 'ready', 0, 0)")
+    assert refund(app, 8)['state'] == 'completed'
+    assert app.local_db().execute("SELECT count(*) FROM status_outbox WHERE order_id = 8").fetchone()[0] == 0
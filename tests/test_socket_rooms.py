@@ -0,0 +1,70 @@
+import pytest
+
+CLIENTS_PER_STORE = 5
+
+
+@pytest.fixture
+def connect(app):
+    clients = []
+
+    def connect(store=None, namespace='/'):
+        auth = {'token': app.SEC_KEY} | ({'store': store} if store else {})
+        client = app.socketio.test_client(app.app, namespace=namespace, auth=auth)
+        assert client.is_connected(namespace)
+        clients.append((client, namespace))
+        return client
+    yield connect
+    for client, namespace in clients:
+        client.disconnect(namespace)
+
+
+def order_deltas(client, namespace='/'):
+    return [event['args'][0] for event in client.get_received(namespace) if event['name'] == 'order_delta']
+
+
+def order(order_id, store_name):
+    return {'ORDER_ID': order_id, 'SHOP': store_name, 'STATUS': 'wc-ready'}
+
+
+def test_delta_reaches_every_tablet_of_its_store_only(app, connect):
+    stores = {store: [connect(store) for _ in range(CLIENTS_PER_STORE)] for store in ('Pub', 'Snack')}
+    everything = [connect() for _ in range(2)]  # no store: the clients of every store
+
+    record = app.publish_order_delta('order_delta', 1, order(1, 'Pub'))
+
+    for client in stores['Pub'] + everything:
+        assert order_deltas(client) == [record]
+    for client in stores['Snack']:
+        assert order_deltas(client) == []
+
+
+def test_delta_of_a_moved_order_reaches_both_stores(app, connect):
+    pub, snack, pizzaria = connect('Pub'), connect('Snack'), connect('Pizzaria')
+
+    record = app.publish_order_delta('order_delta', 2, order(2, 'Snack'), previous_store='Pub')
+
+    assert order_deltas(pub) == order_deltas(snack) == [record]
+    assert order_deltas(pizzaria) == []
+
+
+def test_delta_without_a_store_reaches_everyone(app, connect):
+    clients = [connect('Pub'), connect('Snack'), connect()]
+    app.publish_order_delta('order_delta', 3, None)
+    assert all(len(order_deltas(client)) == 1 for client in clients)
+
+
+def test_join_store_switches_the_room(app, connect):
+    client = connect('Pub')
+    assert client.emit('join_store', {'store': 'Snack'}, callback=True) == {'room': 'store:Snack'}
+
+    app.publish_order_delta('order_delta', 4, order(4, 'Pub'))
+    assert order_deltas(client) == []
+    app.publish_order_delta('order_delta', 5, order(5, 'Snack'))
+    assert [delta['order_id'] for delta in order_deltas(client)] == [5]
+
+
+@pytest.mark.parametrize('namespace', ['/', '/ws'])
+def test_each_namespace_gets_the_delta_once(app, connect, namespace):
+    clients = [connect('Pub', namespace) for _ in range(CLIENTS_PER_STORE)]
+    app.publish_order_delta('order_delta', 6, order(6, 'Pub'))
+    assert all(len(order_deltas(client, namespace)) == 1 for client in clients)